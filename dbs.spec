@@ -98,6 +98,7 @@ install -p -D -m 0644 htdocs/wsgi.py \
 
 # install worker unit file
 install -p -D -m 0644 conf/systemd/dbs-worker.service %{buildroot}%{_unitdir}/dbs-worker.service
+install -p -D -m 0644 conf/systemd/dbs-worker@.service %{buildroot}%{_unitdir}/dbs-worker@.service
 
 # install directories for static content and site media
 install -p -d -m 0775 htdocs/static \
@@ -206,6 +207,7 @@ usermod -a -G docker dbs || :
 %files worker
 %doc README-worker.md
 %{_unitdir}/dbs-worker.service
+%{_unitdir}/dbs-worker@.service
 
 
 %changelog
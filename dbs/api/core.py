@@ -1,21 +1,114 @@
 from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
 
+import hashlib
+import json
 import logging
-from datetime import datetime
+import time
+from celery.result import AsyncResult
+from celery.utils import uuid
+from datetime import timedelta
+from functools import partial
 
-from ..models import Task, Dockerfile, Image
+from django.conf import settings
+from django.utils import timezone
+
+from ..cache import image_cache
+from ..celery import app
+from ..dispatcher import get_dispatcher
+from ..models import Task, TaskTiming, Dockerfile, Image, PackageSet
+from ..notifier import get_notifier
 from ..utils import chain_dict_get
 
 
 logger = logging.getLogger(__name__)
 
 
+BUILD_IMAGE = 'buildroot-fedora'
+
+
+def build_fingerprint(cleaned_data, build_image=BUILD_IMAGE):
+    """
+    return fingerprint of a build request; requests with the same fingerprint
+    build the same image, tagged and pushed to the same registries
+
+    Builds without git_commit follow a branch, which may move anytime,
+    they have no fingerprint (None). Changes of the parent image are
+    reflected by invalidation of images built on it.
+    """
+    if not cleaned_data.get('git_commit'):
+        return None
+    key = [
+        cleaned_data['git_url'],
+        cleaned_data['git_commit'],
+        cleaned_data.get('git_dockerfile_path') or '',
+        build_image,
+        cleaned_data.get('parent_registry') or '',
+        sorted(cleaned_data.get('repos') or []),
+        # a reused build does not push its image anywhere else
+        cleaned_data.get('tag') or '',
+        sorted(cleaned_data.get('target_registries') or []),
+    ]
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def reused_build_response(task):
+    """
+    return response of new build request answered by existing build task
+    """
+    response = {'task_id': task.id, 'reused': True}
+    if hasattr(task, 'image'):
+        response['image_id'] = task.image.hash
+    return response
+
+
+def new_build_task(owner, task_data, fingerprint=None):
+    """
+    return new (unsaved) Task for a build
+
+    celery task id is stored before the task is sent,
+    so that workers always find the Task
+    """
+    return Task(builddev_id=BUILD_IMAGE, status=Task.STATUS_PENDING, type=Task.TYPE_BUILD,
+                owner=owner, task_data=task_data, celery_id=uuid(), fingerprint=fingerprint)
+
+
+def new_build_kwargs(cleaned_data, owner, task):
+    """
+    return arguments of TaskApi.build_docker_image for a saved build Task
+    """
+    build_kwargs = dict(cleaned_data)
+    build_kwargs.update({'build_image': BUILD_IMAGE, 'local_tag': '%s.%s' % (owner, cleaned_data['tag']),
+                         'callback': partial(new_image_callback, task.id), 'task_id': task.celery_id})
+    return build_kwargs
+
+
+def finish_task(task_id):
+    """
+    mark task as finished, so that its results are stored only once even
+    when several processes watch it (see watch_unfinished_tasks)
+
+    :return: False if the task was finished already
+    """
+    return bool(Task.objects.filter(id=task_id, date_finished__isnull=True).update(date_finished=timezone.now()))
+
+
 def new_image_callback(task_id, build_results):
+    """
+    store results of a build task
+
+    :return: False if the results were stored already
+    """
+    started = time.time()
+    if not finish_task(task_id):
+        logger.info("results of task %s are stored already", task_id)
+        return False
     build_logs = getattr(build_results, 'build_logs', None)
     t = Task.objects.get(id=task_id)
-    t.date_finished = datetime.now()
     if build_logs:
-        t.log = '\n'.join(build_logs)
+        t.append_log('\n'.join(build_logs))
+    worker_cache_use = getattr(build_results, 'image_cache', None)
+    if worker_cache_use:
+        t.result = json.dumps({'image_cache': worker_cache_use})
     if build_results:
         image_id = getattr(build_results, "built_img_info", {}).get("Id", None)
         logger.debug("image_id = %s", image_id)
@@ -27,37 +120,102 @@ def new_image_callback(task_id, build_results):
         logger.debug("parent_tags = %s", parent_tags)
         df = getattr(build_results, "dockerfile", None)
         if image_id and parent_image_id:
-            parent_image = Image.create(parent_image_id, Image.STATUS_BASE, tags=parent_tags)
+            # parent built by dbs keeps its task and place in the lineage
+            parent_image = Image.objects.filter(hash=parent_image_id).first() or \
+                Image.create(parent_image_id, Image.STATUS_BASE, tags=parent_tags)
             image = Image.create(image_id, Image.STATUS_BUILD, tags=image_tags,
                                  task=t, parent=parent_image)
             if df:
                 df_model = Dockerfile(content=df)
                 df_model.save()
                 image.dockerfile = df_model
-                image.save()
+                image.save(update_fields=['dockerfile'])
             rpm_list = getattr(build_results, "built_img_plugins_output", {}).get("all_packages", None)
             base_rpm_list = getattr(build_results, "base_plugins_output", {}).get("all_packages", None)
-            if rpm_list:
-                image.add_rpms_list(rpm_list)
             if base_rpm_list:
-                image.add_rpms_list(base_rpm_list)
+                # manifest of the base image is shared by all images built on it,
+                # the built image is stored as a difference against it
+                base_set = PackageSet.objects.get_or_create_from_nvrs(base_rpm_list)
+                image.add_rpms_list((rpm_list or []) + base_rpm_list, base=base_set)
+            elif rpm_list:
+                image.add_rpms_list(rpm_list)
+            t.status = Task.STATUS_SUCCESS
         else:
             t.status = Task.STATUS_FAILED
-
-        t.status = Task.STATUS_SUCCESS
     else:
         t.status = Task.STATUS_FAILED
+    timings = dict(getattr(build_results, 'timings', None) or {})
+    timings[TaskTiming.PHASE_INGEST] = time.time() - started
+    t.record_timings(timings)
     t.save()
+    get_notifier().notify(t.id, t.get_status_display())
+    return True
 
 
 def move_image_callback(task_id, response):
+    """
+    store results of a push task
+
+    :return: False if the results were stored already
+    """
+    started = time.time()
     logger.debug("move callback: %s %s", task_id, response)
+    if not finish_task(task_id):
+        logger.info("results of task %s are stored already", task_id)
+        return False
     t = Task.objects.get(id=task_id)
-    t.date_finished = datetime.now()
-    if response and response.get("error", False):
+    if not response or response.get("error", False):
         t.status = Task.STATUS_FAILED
     else:
         t.status = Task.STATUS_SUCCESS
+    if response:
+        t.result = json.dumps(response)
+    timings = dict(response and response.get("timings") or {})
+    timings[TaskTiming.PHASE_INGEST] = time.time() - started
+    t.record_timings(timings)
     t.save()
+    get_notifier().notify(t.id, t.get_status_display())
+    image_id = json.loads(t.task_data.json).get('image_id')
+    if image_id:
+        image_cache.evict([image_id])
+    return True
+
+
+def watch_unfinished_tasks():
+    """
+    watch results of all unfinished tasks again and store them when they finish
+
+    Callbacks live only in the process which sent the tasks, so they are
+    lost when it exits; this is called when a process starts. Tasks which
+    are watched by another process too are stored only once. Tasks older
+    than DBS_TASK_TIMEOUT are not expected to finish anymore (e.g. their
+    results expired), they are stored as failed.
+
+    :return: number of watched tasks
+    """
+    from ..models import RebuildStep
+    from ..rebuild import rebuild_step_callback
+    cutoff = timezone.now() - timedelta(seconds=settings.DBS_TASK_TIMEOUT)
+    unfinished = Task.objects.filter(date_finished__isnull=True,
+                                     status__in=(Task.STATUS_PENDING, Task.STATUS_RUNNING))
+    steps = dict(RebuildStep.objects.filter(status=RebuildStep.STATUS_RUNNING, task__in=unfinished)
+                 .values_list('task', 'id'))
+    watched = 0
+    for task_id, task_type, celery_id, date_started in unfinished.order_by('id') \
+            .values_list('id', 'type', 'celery_id', 'date_started'):
+        if task_type == Task.TYPE_MOVE:
+            callback = partial(move_image_callback, task_id)
+        elif task_id in steps:
+            callback = partial(rebuild_step_callback, steps[task_id], task_id)
+        else:
+            callback = partial(new_image_callback, task_id)
+        if not celery_id or date_started < cutoff:
+            logger.warning("task %s is lost, storing it as failed", task_id)
+            callback(None)
+        else:
+            get_dispatcher().watch(AsyncResult(celery_id, app=app), callback)
+            watched += 1
+    logger.info("watching %d unfinished tasks", watched)
+    return watched
 
 
@@ -3,18 +3,39 @@ from __future__ import absolute_import, division, generators, nested_scopes, pri
 from django import forms
 
 
+class StringListField(forms.MultipleChoiceField):
+    """ list of arbitrary strings """
+    def valid_value(self, value):
+        return True
+
+
 class NewImageForm(forms.Form):
     git_url             = forms.URLField()
     git_commit          = forms.CharField(required=False)
     git_dockerfile_path = forms.CharField(required=False)
     tag                 = forms.CharField()
     parent_registry     = forms.CharField(required=False)
-    target_registries   = forms.MultipleChoiceField(required=False)
-    repos               = forms.MultipleChoiceField(required=False)
+    target_registries   = StringListField(required=False)
+    repos               = StringListField(required=False)
+    # build even if identical build already exists
+    force               = forms.BooleanField(required=False)
 
 
 class MoveImageForm(forms.Form):
     source_registry     = forms.CharField()
-    target_registry     = forms.CharField()
-    tags                = forms.MultipleChoiceField()
+    target_registries   = StringListField(required=False)
+    # single registry, kept for older clients
+    target_registry     = forms.CharField(required=False)
+    tags                = StringListField()
+
+    def clean(self):
+        cleaned_data = super(MoveImageForm, self).clean()
+        target_registries = cleaned_data.get('target_registries') or []
+        target_registry = cleaned_data.pop('target_registry', None)
+        if target_registry and target_registry not in target_registries:
+            target_registries.append(target_registry)
+        if not target_registries:
+            raise forms.ValidationError('At least one target registry is required.')
+        cleaned_data['target_registries'] = target_registries
+        return cleaned_data
 
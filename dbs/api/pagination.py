@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import base64
+import json
+
+from django.core.exceptions import SuspiciousOperation
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.six import integer_types, string_types
+
+
+def encode_cursor(values):
+    """
+    serialize dict of keyset values into opaque url-safe string
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, fields):
+    """
+    inverse of encode_cursor; returns None for empty cursor
+
+    :param fields: dict {name: type or tuple of types} of values the cursor
+                   has to contain, None is allowed when type of None is listed
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise SuspiciousOperation('Invalid cursor: {}'.format(cursor))
+    if not isinstance(values, dict):
+        raise SuspiciousOperation('Invalid cursor: {}'.format(cursor))
+    for name, types in fields.items():
+        value = values.get(name)
+        # bool is an int too
+        if name not in values or isinstance(value, bool) or not isinstance(value, types):
+            raise SuspiciousOperation('Invalid cursor: {}'.format(cursor))
+    return values
+
+
+def paginate_images(queryset, cursor, page_size):
+    """
+    return one page of images ordered by hash and cursor of the next page
+
+    :param queryset: filtered images
+    :param cursor: cursor returned with the previous page or None
+    :param page_size: maximal number of images in page
+    :return: tuple (list of images, next cursor or None)
+    """
+    values = decode_cursor(cursor, {'hash': string_types})
+    if values:
+        queryset = queryset.filter(hash__gt=values['hash'])
+    results = list(queryset.order_by('hash')[:page_size + 1])
+    if len(results) <= page_size:
+        return results, None
+    results = results[:page_size]
+    return results, encode_cursor({'hash': results[-1].hash})
+
+
+def paginate_tasks(queryset, cursor, page_size):
+    """
+    return one page of tasks and cursor of the next page
+
+    unfinished tasks come first (newest first), then finished tasks
+    ordered by (date_finished, id) descending; NULLs are handled here
+    explicitly because each backend sorts them differently
+
+    :param queryset: filtered tasks
+    :param cursor: cursor returned with the previous page or None
+    :param page_size: maximal number of tasks in page
+    :return: tuple (list of tasks, next cursor or None)
+    """
+    values = decode_cursor(cursor, {'id': integer_types, 'date_finished': string_types + (type(None),)})
+    finished = queryset.filter(date_finished__isnull=False)
+    results = []
+    if values is None or values.get('date_finished') is None:
+        unfinished = queryset.filter(date_finished__isnull=True)
+        if values is not None:
+            unfinished = unfinished.filter(id__lt=values['id'])
+        results = list(unfinished.order_by('-id')[:page_size + 1])
+    else:
+        try:
+            date_finished = parse_datetime(values['date_finished'])
+        except ValueError:
+            # well formatted, but not a valid datetime
+            date_finished = None
+        if date_finished is None:
+            raise SuspiciousOperation('Invalid cursor: {}'.format(cursor))
+        finished = finished.filter(
+            Q(date_finished__lt=date_finished) |
+            Q(date_finished=date_finished, id__lt=values['id'])
+        )
+    remaining = page_size + 1 - len(results)
+    if remaining > 0:
+        results.extend(finished.order_by('-date_finished', '-id')[:remaining])
+    if len(results) <= page_size:
+        return results, None
+    results = results[:page_size]
+    last = results[-1]
+    return results, encode_cursor({
+        'date_finished': last.date_finished and last.date_finished.isoformat(),
+        'id': last.id,
+    })
@@ -8,14 +8,24 @@ from django.views.decorators.csrf import csrf_exempt
 
 urlpatterns = patterns('',
     url(r'^tasks$', views.ListTasksCall.as_view()),
+    url(r'^tasks/timings$', views.TaskTimingsCall.as_view()),
     url(r'^images$', views.ListImagesCall.as_view()),
     url(r'^image/(?P<image_id>[a-zA-Z0-9]+)/status$', views.ImageStatusCall.as_view()),
     url(r'^image/(?P<image_id>[a-zA-Z0-9]+)/deps$', views.ImageDepsCall.as_view()),
     url(r'^image/(?P<image_id>[a-zA-Z0-9]+)/info$', views.ImageInfoCall.as_view()),
     url(r'^task/(?P<task_id>[0-9]+)/status$', views.TaskStatusCall.as_view()),
+    url(r'^task/(?P<task_id>[0-9]+)/log$', views.TaskLogCall.as_view()),
+    url(r'^task/(?P<task_id>[0-9]+)/wait$', views.TaskWaitCall.as_view()),
+    url(r'^task/(?P<task_id>[0-9]+)/events$', views.TaskEventsCall.as_view()),
+    url(r'^dispatcher/stats$', views.DispatcherStatsCall.as_view()),
+    url(r'^cache/stats$', views.CacheStatsCall.as_view()),
+    url(r'^metrics$', views.MetricsCall.as_view()),
+    url(r'^rebuild/(?P<run_id>[0-9]+)$', views.RebuildStatusCall.as_view()),
 
     url(r'^image/new$', csrf_exempt(views.NewImageCall.as_view())),
+    url(r'^images/batch$', csrf_exempt(views.NewImagesBatchCall.as_view())),
     url(r'^image/move/(?P<image_id>[a-zA-Z0-9]+)$', csrf_exempt(views.MoveImageCall.as_view())),
     url(r'^image/rebuild/(?P<image_id>[a-zA-Z0-9]+)$', csrf_exempt(views.RebuildImageCall.as_view())),
+    url(r'^image/rebuild-tree/(?P<image_id>[a-zA-Z0-9]+)$', csrf_exempt(views.RebuildTreeCall.as_view())),
     url(r'^image/invalidate/(?P<image_id>[a-zA-Z0-9:]+)$', csrf_exempt(views.InvalidateImageCall.as_view())),
 )
@@ -1,28 +1,101 @@
 from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
 
+import calendar
 import json
 import logging
+import time
+from datetime import timedelta
 
+from celery.utils import uuid
+from django.conf import settings
 from django.core.exceptions import (
     ObjectDoesNotExist, PermissionDenied, SuspiciousOperation
 )
+from django.db import transaction
 from django.db.models import Model, QuerySet
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.http.response import HttpResponseBase
+from django.utils import timezone
+from django.utils.encoding import force_text
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 from django.views.generic import View
 from django.views.generic.edit import FormMixin
 from functools import partial
 
 from .core import (
-    new_image_callback, move_image_callback,
+    build_fingerprint, move_image_callback, new_build_kwargs, new_build_task, reused_build_response,
 )
 from .forms import NewImageForm, MoveImageForm
+from .pagination import paginate_images, paginate_tasks
+from ..cache import image_cache
+from ..dispatcher import get_dispatcher
+from ..metrics import metrics, observe_serialization
+from ..notifier import get_notifier
 from ..task_api import TaskApi
-from ..models import Image, Task, TaskData
+from ..models import Image, ImageLineage, RebuildRun, Task, TaskData, TaskTiming
+from ..rebuild import start_rebuild
 
 
 logger = logging.getLogger(__name__)
 builder_api = TaskApi()
 
+FINISHED_STATUS_NAMES = (
+    Task._STATUS_NAMES[Task.STATUS_FAILED],
+    Task._STATUS_NAMES[Task.STATUS_SUCCESS],
+)
+
+
+def get_int_param(request, name, default=None):
+    """
+    return non-negative integer value of query parameter or default
+    """
+    value = request.GET.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise SuspiciousOperation('Invalid value of parameter {}: {}'.format(name, value))
+    if value < 0:
+        raise SuspiciousOperation('Invalid value of parameter {}: {}'.format(name, value))
+    return value
+
+
+def get_bool_param(request, name, default=None):
+    """
+    return boolean value of query parameter or default
+    """
+    value = request.GET.get(name)
+    if value is None or value == '':
+        return default
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise SuspiciousOperation('Invalid value of parameter {}: {}'.format(name, value))
+
+
+def get_choice_param(request, name, choices, default=None):
+    """
+    return value of query parameter given either as a number
+    or as a (case insensitive) name from choices dict
+    """
+    value = request.GET.get(name)
+    if value is None or value == '':
+        return default
+    for key, label in choices.items():
+        if value == str(key) or value.lower() == label.lower():
+            return key
+    raise SuspiciousOperation('Invalid value of parameter {}: {}'.format(name, value))
+
+
+def get_page_size(request):
+    """
+    return page size requested by query parameter limit, capped by settings
+    """
+    limit = get_int_param(request, 'limit', settings.DBS_API_PAGE_SIZE)
+    return max(1, min(limit, settings.DBS_API_MAX_PAGE_SIZE))
+
 
 def translate_args(translation_dict, values):
     """
@@ -52,12 +125,45 @@ class ModelJSONEncoder(json.JSONEncoder):
 class JsonView(View):
     """
     Overrides dispatch method to always return JsonResponse.
+
+    Views may implement get_validators to support conditional GET requests.
     """
+    def get_validators(self, request, *args, **kwargs):
+        """
+        return tuple (etag, last_modified) describing current state of the
+        requested resource (either may be None), or None if conditional
+        requests are not supported; this has to be much cheaper than
+        the handler itself
+        """
+        return None
+
+    def is_modified(self, request, etag, last_modified):
+        """
+        check If-None-Match and If-Modified-Since headers of request
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            # newer versions of Django keep the quotes
+            return not ('*' in etags or etag and (etag in etags or quote_etag(etag) in etags))
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_modified_since and last_modified:
+            return int(calendar.timegm(last_modified.utctimetuple())) > if_modified_since
+        return True
+
     def dispatch(self, request, *args, **kwargs):
+        validators = None
         try:
-            response = super(JsonView, self).dispatch(request, *args, **kwargs)
-            if not isinstance(response, JsonResponse):
-                response = JsonResponse(response, encoder=ModelJSONEncoder, safe=False)
+            if request.method in ('GET', 'HEAD'):
+                validators = self.get_validators(request, *args, **kwargs)
+            if validators and not self.is_modified(request, *validators):
+                response = HttpResponseNotModified()
+            else:
+                response = super(JsonView, self).dispatch(request, *args, **kwargs)
+                if not isinstance(response, HttpResponseBase):
+                    started = time.time()
+                    response = JsonResponse(response, encoder=ModelJSONEncoder, safe=False)
+                    observe_serialization(time.time() - started)
         except ObjectDoesNotExist:
             logger.warning('Not Found: %s', request.path,
                 extra={'status_code': 404, 'request': request})
@@ -81,6 +187,12 @@ class JsonView(View):
                 extra={'status_code': 500, 'request': request})
             response = JsonResponse({'error': 'Internal Server Error'})
             response.status_code = 500
+        if validators and response.status_code in (200, 304):
+            etag, last_modified = validators
+            if etag:
+                response['ETag'] = quote_etag(etag)
+            if last_modified:
+                response['Last-Modified'] = http_date(calendar.timegm(last_modified.utctimetuple()))
         return response
 
 
@@ -119,49 +231,301 @@ class FormJsonView(FormMixin, JsonView):
 
 
 
-class ImageStatusCall(JsonView):
+class ImageValidatorsMixin(object):
+    kind = None
+
+    def get_validators(self, request, image_id):
+        # version of image changes whenever its cached responses are evicted
+        version = image_cache.get_version(image_id)
+        if version is None:
+            return None
+        return '%s-%s-%s-%s' % (self.kind, image_id, version, request.GET.urlencode()), None
+
+
+
+class ImageStatusCall(ImageValidatorsMixin, JsonView):
+    kind = 'status'
+
     def get(self, request, image_id):
-        img = Image.objects.get(hash=image_id)
-        return {
-            'image_id': image_id,
-            'status': img.get_status_display(),
-        }
+        def get_status():
+            img = Image.objects.only('status').get(hash=image_id)
+            return {
+                'image_id': image_id,
+                'status': img.get_status_display(),
+            }
+        return image_cache.get_or_set(image_id, 'status', get_status)
 
 
 
-class ImageInfoCall(JsonView):
+class ImageInfoCall(ImageValidatorsMixin, JsonView):
+    kind = 'info'
+
     def get(self, request, image_id):
-        return Image.objects.get(hash=image_id)
+        return image_cache.get_or_set(
+            image_id, 'info', lambda: Image.objects.select_related('task').get(hash=image_id).__json__())
 
 
 
-class ImageDepsCall(JsonView):
-    def get_deps(self, image):
-        return {
-            'image_id': image.hash,
-            'deps': [self.get_deps(i) for i in image.children()],
-        }
+class ImageDepsCall(ImageValidatorsMixin, JsonView):
+    kind = 'deps'
+
     def get(self, request, image_id):
-        image = Image.objects.get(hash=image_id)
-        return self.get_deps(image)
+        """
+        return tree of images built on top of image_id
+
+        optional query parameters:
+            max_depth -- do not descend deeper than this many generations
+            limit     -- maximal number of descendants in response
+        """
+        max_depth = get_int_param(request, 'max_depth')
+        limit = get_int_param(request, 'limit')
+        return image_cache.get_or_set(image_id, 'deps:%s:%s' % (max_depth, limit),
+                                      lambda: self.get_deps(image_id, max_depth, limit))
+
+    def get_deps(self, image_id, max_depth, limit):
+        image = Image.objects.only('hash').get(hash=image_id)
+        links = ImageLineage.objects.filter(ancestor=image, depth__gt=0)
+        if max_depth is not None:
+            links = links.filter(depth__lte=max_depth)
+        links = links.order_by('depth', 'descendant').values_list('descendant', 'descendant__parent')
+        if limit is not None:
+            links = links[:limit + 1]
+        links = list(links)
+        truncated = limit is not None and len(links) > limit
+        if truncated:
+            links = links[:limit]
+        nodes = {image.hash: {'image_id': image.hash, 'deps': []}}
+        # links are ordered by depth, so parent is always processed before child
+        for child_id, parent_id in links:
+            if parent_id not in nodes:
+                logger.warning('Image lineage of %s is out of sync with parent links', child_id)
+                continue
+            node = {'image_id': child_id, 'deps': []}
+            nodes[child_id] = node
+            nodes[parent_id]['deps'].append(node)
+        response = nodes[image.hash]
+        if truncated:
+            response['truncated'] = True
+        return response
 
 
 
 class ListImagesCall(JsonView):
     def get(self, request):
-        return Image.objects.all()
+        """
+        return one page of images ordered by hash
+
+        optional query parameters:
+            status          -- filter by status (name or number)
+            is_invalidated  -- filter by invalidation flag
+            limit           -- page size
+            cursor          -- value of "next" from the previous page
+        """
+        images = Image.objects.select_related('task')
+        status = get_choice_param(request, 'status', Image._STATUS_NAMES)
+        if status is not None:
+            images = images.filter(status=status)
+        is_invalidated = get_bool_param(request, 'is_invalidated')
+        if is_invalidated is not None:
+            images = images.filter(is_invalidated=is_invalidated)
+        results, next_cursor = paginate_images(images, request.GET.get('cursor'), get_page_size(request))
+        return {'results': Image.prefetch_related_data(results), 'next': next_cursor}
 
 
 
 class TaskStatusCall(JsonView):
+    def get_validators(self, request, task_id):
+        try:
+            status, date_finished = Task.objects.filter(id=task_id).values_list('status', 'date_finished')[0]
+        except IndexError:
+            return None
+        etag = 'task-%s-%s-%s' % (task_id, status, date_finished and date_finished.isoformat())
+        # response of unfinished task changes (status, timings) without
+        # moving any date, only the ETag describes it
+        finished = status in (Task.STATUS_FAILED, Task.STATUS_SUCCESS)
+        return etag, date_finished if finished else None
+
+    def get(self, request, task_id):
+        task = Task.objects.get(id=task_id)
+        response = task.__json__()
+        response['timings'] = task.timings_as_dict()
+        return response
+
+
+
+class TaskTimingsCall(JsonView):
+    def get(self, request):
+        """
+        return number of records, median and 95th percentile of duration
+        of every phase of tasks
+
+        optional query parameters:
+            hours -- consider tasks from last hours only (default 24)
+        """
+        hours = get_int_param(request, 'hours', 24)
+        since = timezone.now() - timedelta(hours=hours)
+        return {
+            'hours': hours,
+            'phases': TaskTiming.objects.filter(date_recorded__gte=since).percentiles(),
+        }
+
+
+
+class TaskWaitCall(JsonView):
     def get(self, request, task_id):
-        return Task.objects.get(id=task_id)
+        """
+        wait until task finishes and return its status
+
+        optional query parameters:
+            timeout -- maximal number of seconds to wait
+        """
+        timeout = min(get_int_param(request, 'timeout', settings.DBS_LONG_POLL_MAX_TIMEOUT),
+                      settings.DBS_LONG_POLL_MAX_TIMEOUT)
+        deadline = time.time() + timeout
+        notifier = get_notifier()
+        # subscribe before reading the task, so no change can be missed
+        subscription = notifier.subscribe(task_id)
+        try:
+            task = Task.objects.get(id=task_id)
+            while not task.is_finished():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                message = subscription.get(min(remaining, notifier.poll_interval or remaining))
+                # the task may have been finished by another process, which
+                # notifies only its own subscribers, read it after every wait
+                if message is None or message['status'] in FINISHED_STATUS_NAMES:
+                    task = Task.objects.get(id=task_id)
+        finally:
+            subscription.close()
+        response = task.__json__()
+        response['timeout'] = not task.is_finished()
+        return response
+
+
+
+class TaskEventsCall(JsonView):
+    keepalive = 15
+
+    def get(self, request, task_id):
+        """
+        stream changes of task status as server-sent events until the task finishes
+        """
+        subscription = get_notifier().subscribe(task_id)
+        try:
+            task = Task.objects.get(id=task_id)
+        except Exception:
+            subscription.close()
+            raise
+        response = StreamingHttpResponse(self.events(task, subscription), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def events(self, task, subscription):
+        deadline = time.time() + settings.DBS_EVENT_STREAM_MAX_DURATION
+        poll_interval = get_notifier().poll_interval
+        try:
+            message = {'task_id': task.id, 'status': task.get_status_display()}
+            status = None
+            last_sent = time.time()
+            while True:
+                if message is not None and message['status'] != status:
+                    yield 'event: status\ndata: {}\n\n'.format(json.dumps(message))
+                    status = message['status']
+                    last_sent = time.time()
+                elif time.time() - last_sent >= self.keepalive:
+                    yield ': keepalive\n\n'
+                    last_sent = time.time()
+                if status in FINISHED_STATUS_NAMES or time.time() >= deadline:
+                    break
+                message = subscription.get(min(self.keepalive, poll_interval or self.keepalive,
+                                               max(deadline - time.time(), 0)))
+                if message is None and poll_interval:
+                    # changes made by other processes are not notified here
+                    task = Task.objects.get(id=task.id)
+                    message = {'task_id': task.id, 'status': task.get_status_display()}
+        finally:
+            subscription.close()
+
+
+
+class TaskLogCall(JsonView):
+    def get(self, request, task_id):
+        """
+        return part of task log
+
+        offset and positions in the log count characters, not bytes
+
+        optional query parameters:
+            offset  -- return only log after this position; pass value
+                       of "offset" from the previous response to tail the log
+        """
+        offset = get_int_param(request, 'offset', 0)
+        task = Task.objects.get(id=task_id)
+        log, offset = task.read_log(offset)
+        return {
+            'task_id': task.id,
+            'status': task.get_status_display(),
+            'finished': task.is_finished(),
+            'log': log,
+            'offset': offset,
+        }
 
 
 
 class ListTasksCall(JsonView):
     def get(self, request):
-        return Task.objects.all()
+        """
+        return one page of tasks, unfinished first, then by date_finished
+
+        optional query parameters:
+            status  -- filter by status (name or number)
+            type    -- filter by type (name or number)
+            owner   -- filter by owner
+            limit   -- page size
+            cursor  -- value of "next" from the previous page
+        """
+        tasks = Task.objects.select_related('image', 'task_data')
+        status = get_choice_param(request, 'status', Task._STATUS_NAMES)
+        if status is not None:
+            tasks = tasks.filter(status=status)
+        task_type = get_choice_param(request, 'type', Task._TYPE_NAMES)
+        if task_type is not None:
+            tasks = tasks.filter(type=task_type)
+        owner = request.GET.get('owner')
+        if owner:
+            tasks = tasks.filter(owner=owner)
+        results, next_cursor = paginate_tasks(tasks, request.GET.get('cursor'), get_page_size(request))
+        return {'results': results, 'next': next_cursor}
+
+
+
+class CacheStatsCall(JsonView):
+    def get(self, request):
+        return image_cache.stats()
+
+
+
+class DispatcherStatsCall(JsonView):
+    def get(self, request):
+        return get_dispatcher().stats()
+
+
+
+class MetricsCall(JsonView):
+    def get(self, request):
+        """ return request metrics, dispatcher and cache stats in Prometheus text format """
+        gauges = [
+            ('dbs_dispatcher_%s' % name, 'Result dispatcher: %s.' % name.replace('_', ' '), (), value)
+            for name, value in sorted(get_dispatcher().stats().items())
+        ]
+        cache_stats = image_cache.stats()
+        for result in ('hits', 'misses'):
+            gauges.extend(
+                ('dbs_cache_%s' % result, 'Image response cache %s.' % result, (('kind', kind),), count)
+                for kind, count in sorted(cache_stats[result].items())
+            )
+        return HttpResponse(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 
@@ -169,22 +533,92 @@ class NewImageCall(FormJsonView):
     form_class  = NewImageForm
 
     def form_valid(self, form):
-        """ initiate a new build """
+        """
+        initiate a new build; if identical build is in progress or has
+        already succeeded, return it instead (unless force is set)
+        """
         cleaned_data = form.cleaned_data
+        force = cleaned_data.pop('force')
         owner = 'testuser'  # XXX: hardcoded
         logger.debug('cleaned_data = %s', cleaned_data)
-        local_tag = '%s.%s' % (owner, cleaned_data['tag'])
+        fingerprint = build_fingerprint(cleaned_data)
+        if fingerprint and not force:
+            task = Task.objects.reusable([fingerprint]).get(fingerprint)
+            if task:
+                logger.info('reusing task %d for build %s', task.id, fingerprint)
+                return reused_build_response(task)
         td = TaskData(json=json.dumps(cleaned_data))
         td.save()
-        t = Task(builddev_id='buildroot-fedora', status=Task.STATUS_PENDING,
-                 type=Task.TYPE_BUILD, owner=owner, task_data=td)
-        t.save()
-        cleaned_data.update({'build_image': 'buildroot-fedora', 'local_tag': local_tag,
-                     'callback': partial(new_image_callback, t.id)})
-        task_id = builder_api.build_docker_image(**cleaned_data)
-        t.celery_id = task_id
+        t = new_build_task(owner, td, fingerprint)
         t.save()
-        return {'task_id': t.id}
+        builder_api.build_docker_image(**new_build_kwargs(cleaned_data, owner, t))
+        return {'task_id': t.id, 'reused': False}
+
+
+
+class NewImagesBatchCall(JsonView):
+    def post(self, request):
+        """
+        initiate several builds at once
+
+        request body is a list of NewImageCall requests, response contains
+        list of results in the same order, each with either task_id or errors;
+        identical builds are started only once
+        """
+        try:
+            items = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            raise SuspiciousOperation('Request body is not valid JSON')
+        if not isinstance(items, list):
+            raise SuspiciousOperation('Request body is not a list')
+        if len(items) > settings.DBS_API_MAX_BATCH_SIZE:
+            raise SuspiciousOperation('Too many items in batch: {}'.format(len(items)))
+        owner = 'testuser'  # XXX: hardcoded
+        results = []
+        valid = []
+        for item in items:
+            form = NewImageForm(data=item if isinstance(item, dict) else {})
+            if isinstance(item, dict) and form.is_valid():
+                force = form.cleaned_data.pop('force')
+                valid.append((len(results), form.cleaned_data, build_fingerprint(form.cleaned_data), force))
+                results.append(None)
+            else:
+                results.append({'errors': form.errors if isinstance(item, dict) else {'__all__': ['Not an object.']}})
+        reusable = Task.objects.reusable(
+            set(fingerprint for _, _, fingerprint, force in valid if fingerprint and not force))
+        builds = []
+        # index of result of the first build with given fingerprint in this batch
+        duplicates = {}
+        for index, cleaned_data, fingerprint, force in valid:
+            if fingerprint in reusable and not force:
+                results[index] = reused_build_response(reusable[fingerprint])
+            elif fingerprint in duplicates and not force:
+                duplicates[fingerprint].append(index)
+            else:
+                builds.append((index, cleaned_data, fingerprint))
+                if fingerprint:
+                    duplicates.setdefault(fingerprint, [])
+        if builds:
+            with transaction.atomic():
+                task_list = []
+                for _, cleaned_data, fingerprint in builds:
+                    td = TaskData(json=json.dumps(cleaned_data))
+                    td.save()
+                    task_list.append(new_build_task(owner, td, fingerprint))
+                Task.objects.bulk_create(task_list)
+                # bulk_create does not set primary keys on all backends
+                task_ids = dict(Task.objects.filter(celery_id__in=[t.celery_id for t in task_list])
+                                .values_list('celery_id', 'id'))
+            for t in task_list:
+                t.id = task_ids[t.celery_id]
+            builder_api.build_docker_images([
+                new_build_kwargs(cleaned_data, owner, t) for (_, cleaned_data, _), t in zip(builds, task_list)
+            ])
+            for (index, _, fingerprint), t in zip(builds, task_list):
+                results[index] = {'task_id': t.id, 'reused': False}
+                for duplicate in duplicates.pop(fingerprint, []):
+                    results[duplicate] = {'task_id': t.id, 'reused': True}
+        return {'results': results}
 
 
 
@@ -197,12 +631,11 @@ class MoveImageCall(FormJsonView):
         td = TaskData(json=json.dumps(data))
         td.save()
         owner = 'testuser'  # XXX: hardcoded
-        t = Task(type=Task.TYPE_MOVE, owner=owner, task_data=td)
+        t = Task(type=Task.TYPE_MOVE, owner=owner, task_data=td, celery_id=uuid())
         t.save()
         data['callback'] = partial(move_image_callback, t.id)
-        task_id = builder_api.push_docker_image(**data)
-        t.celery_id = task_id
-        t.save()
+        data['task_id'] = t.celery_id
+        builder_api.push_docker_image(**data)
         return {'task_id': t.id}
 
 
@@ -210,34 +643,61 @@ class MoveImageCall(FormJsonView):
 class RebuildImageCall(JsonView):
     """ rebuild provided image; use same response as new_image """
     def post(self, request, image_id):
-        post_args   = json.loads(self.request.body)
-        try:
-            data = json.loads(
-                Image.objects.get(hash=image_id).task.task_data.json
-            )
-        except (ObjectDoesNotExist, AttributeError) as e:
-            logger.error(repr(e))
-            raise ErrorDuringRequest('Image does not exist or was not built from task.')
-        else:
-            if post_args:
-                data.update(post_args)
-        data['image_id'] = image_id
-        td = TaskData(json=json.dumps(data))
-        td.save()
+        post_args   = json.loads(self.request.body or '{}')
+        task = Image.objects.select_related('task__task_data').get(hash=image_id).task
+        if task is None:
+            raise SuspiciousOperation('Image {} was not built from task'.format(image_id))
+        data = json.loads(task.task_data.json)
+        if post_args:
+            data.update(post_args)
+        form = NewImageForm(data=data)
+        if not form.is_valid():
+            return {'errors': form.errors}
+        # rebuild is always forced
+        form.cleaned_data.pop('force')
         owner = 'testuser'  # XXX: hardcoded
-        t = Task(type=Task.TYPE_MOVE, owner=owner, task_data=td)
-        t.save()
-        data['callback'] = partial(move_image_callback, t.id)
-        task_id = builder_api.push_docker_image(**data)
-        t.celery_id = task_id
+        td = TaskData(json=json.dumps(form.cleaned_data))
+        td.save()
+        t = new_build_task(owner, td, build_fingerprint(form.cleaned_data))
         t.save()
+        builder_api.build_docker_image(**new_build_kwargs(form.cleaned_data, owner, t))
         return {'task_id': t.id}
 
 
 
+class RebuildTreeCall(JsonView):
+    def post(self, request, image_id):
+        """
+        rebuild image and all its descendants, parents first
+
+        optional request data:
+            concurrency -- maximal number of builds running at once
+        """
+        post_args = json.loads(self.request.body or '{}')
+        concurrency = post_args.get('concurrency') if isinstance(post_args, dict) else None
+        if concurrency is not None and (not isinstance(concurrency, int) or concurrency < 1):
+            raise SuspiciousOperation('Invalid value of concurrency: {}'.format(concurrency))
+        owner = 'testuser'  # XXX: hardcoded
+        return start_rebuild(image_id, owner, concurrency)
+
+
+
+class RebuildStatusCall(JsonView):
+    def get(self, request, run_id):
+        """ return plan and progress of the rebuild """
+        return RebuildRun.objects.select_related('root').get(id=run_id)
+
+
+
 class InvalidateImageCall(JsonView):
     def post(self, request, image_id):
+        started = time.time()
         count = Image.objects.invalidate(image_id)
-        return {'message': 'Invalidated {} images.'.format(count)}
+        duration = time.time() - started
+        return {
+            'message': 'Invalidated {} images.'.format(count),
+            'count': count,
+            'duration': duration,
+        }
 
 
@@ -0,0 +1,23 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+__all__ = ('get_build_backend', )
+
+
+def get_build_backend():
+    """
+    return instance of build backend configured by DBS_BUILD_BACKEND
+
+    Backends build, pull and push images on workers:
+
+        prepare_image(image, registry=None) -> dict with image, hit and duration
+        build_in_privileged_container(build_image, **kwargs) -> build results
+        build_using_hosts_docker(build_image, **kwargs) -> build results
+        tag_and_push(image, tag, registry)
+
+    where kwargs and build results are those of dock.api build functions;
+    failures are raised as exceptions
+    """
+    return import_string(settings.DBS_BUILD_BACKEND)()
@@ -0,0 +1,26 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+from dock.api import build_image_in_privileged_container, build_image_using_hosts_docker
+from dock.core import DockerTasker
+
+from ..image_cache import get_worker_image_cache
+
+__all__ = ('DockBackend', )
+
+
+class DockBackend(object):
+    """
+    build and push images with dock using docker of the worker
+    """
+
+    def prepare_image(self, image, registry=None):
+        return get_worker_image_cache().pull(image, registry)
+
+    def build_in_privileged_container(self, build_image, **kwargs):
+        return build_image_in_privileged_container(build_image, **kwargs)
+
+    def build_using_hosts_docker(self, build_image, **kwargs):
+        return build_image_using_hosts_docker(build_image, **kwargs)
+
+    def tag_and_push(self, image, tag, registry):
+        DockerTasker().tag_and_push_image(image, tag, reg_uri=registry)
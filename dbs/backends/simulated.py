@@ -0,0 +1,105 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import hashlib
+import logging
+import random
+import time
+import uuid
+
+from django.conf import settings
+
+__all__ = ('SimulatedBackend', 'SimulatedFailure', 'SyntheticBuildResults', 'generate_nvrs')
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'build_duration': (5.0, 30.0),
+    'pull_duration': (0.1, 2.0),
+    'push_duration': (0.5, 5.0),
+    'failure_rate': 0.0,
+    'cache_hit_rate': 0.9,
+    'base_images': 5,
+    'rpms': 300,
+}
+
+
+def generate_nvrs(count, prefix='package'):
+    return ['%s%d-1.%d-%d.fc21' % (prefix, i, i % 7, i % 3 + 1) for i in range(count)]
+
+
+class SyntheticBuildResults(object):
+    """
+    build results with the attributes of dock results which are used by new_image_callback
+    """
+    def __init__(self, image_id, parent_id, rpms, parent_rpms, tags=(), parent_tags=()):
+        self.built_img_info = {'Id': image_id, 'RepoTags': list(tags)}
+        self.base_img_info = {'Id': parent_id, 'RepoTags': list(parent_tags)}
+        self.built_img_plugins_output = {'all_packages': rpms}
+        self.base_plugins_output = {'all_packages': parent_rpms}
+        self.dockerfile = 'FROM %s\nRUN yum -y install %s\n' % (parent_id, ' '.join(rpms[len(parent_rpms):]))
+        self.build_logs = ['Step 0 : FROM %s' % parent_id, 'Step 1 : RUN yum -y install ...',
+                           'Successfully built %s' % image_id[:12]]
+
+
+class SimulatedFailure(RuntimeError):
+    pass
+
+
+class SimulatedBackend(object):
+    """
+    pretend builds, pulls and pushes without docker, e.g. for load tests
+
+    Every operation sleeps for a random number of seconds from the range
+    configured in DBS_SIMULATED_BACKEND and fails with its failure_rate.
+    Images are built on one of base_images base images (chosen by git url)
+    with rpms packages, every built image adds a tenth of that on top.
+    """
+
+    def __init__(self, **config):
+        self.config = dict(DEFAULTS)
+        self.config.update(getattr(settings, 'DBS_SIMULATED_BACKEND', {}))
+        self.config.update(config)
+
+    def _wait(self, operation):
+        low, high = self.config['%s_duration' % operation]
+        time.sleep(random.uniform(low, high))
+
+    def _maybe_fail(self, operation, name):
+        if random.random() < self.config['failure_rate']:
+            raise SimulatedFailure('simulated failure of %s of %s' % (operation, name))
+
+    def prepare_image(self, image, registry=None):
+        started = time.time()
+        name = '%s/%s' % (registry, image) if registry else image
+        hit = random.random() < self.config['cache_hit_rate']
+        if not hit:
+            self._wait('pull')
+            self._maybe_fail('pull', name)
+        return {'image': name, 'hit': hit, 'duration': time.time() - started}
+
+    def build(self, build_image, git_url, image, git_commit=None, target_registries=None, **kwargs):
+        """
+        :return: SyntheticBuildResults of a new image
+        """
+        self._wait('build')
+        self._maybe_fail('build', git_url)
+        rpms = self.config['rpms']
+        base = int(hashlib.sha256(git_url.encode('utf-8')).hexdigest(), 16) % self.config['base_images']
+        parent_id = '%064x' % (base + 1)
+        # packages of base images differ in versions
+        parent_rpms = ['%s-%d' % (nvr, base) for nvr in generate_nvrs(rpms)]
+        image_id = hashlib.sha256(('%s %s %s' % (git_url, git_commit, uuid.uuid4())).encode('utf-8')).hexdigest()
+        image_rpms = parent_rpms + generate_nvrs(max(rpms // 10, 1), prefix='%s-' % image_id[:8])
+        results = SyntheticBuildResults(image_id, parent_id, image_rpms, parent_rpms,
+                                        tags=[image], parent_tags=['base-%d:latest' % base])
+        results.build_logs.extend('Pushed %s to %s' % (image, registry) for registry in target_registries or [])
+        logger.info('simulated build of %s in %s: %s', git_url, build_image, image_id)
+        return results
+
+    build_in_privileged_container = build
+    build_using_hosts_docker = build
+
+    def tag_and_push(self, image, tag, registry):
+        self._wait('push')
+        self._maybe_fail('push', '%s/%s' % (registry, tag))
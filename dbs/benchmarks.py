@@ -0,0 +1,363 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import datetime
+import hashlib
+import json
+import logging
+import math
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .backends.simulated import SyntheticBuildResults, generate_nvrs
+from .models import Content, Image, Package, Rpm, Tag, Task, TaskData, TaskTiming, CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+# name -> function(options) returning JSON serializable results
+SCENARIOS = OrderedDict()
+
+
+def scenario(func):
+    """
+    register function as a benchmark scenario
+    """
+    SCENARIOS[func.__name__] = func
+    return func
+
+
+def threaded(func):
+    """
+    mark scenario which uses the database from several threads; it can not
+    run in a transaction, the database is flushed after it instead
+    """
+    func.threaded = True
+    return func
+
+
+def measure(func, *args, **kwargs):
+    """
+    call func and return dict with wall time and number of queries
+    """
+    reset_queries()
+    with CaptureQueriesContext(connection) as context:
+        started = time.time()
+        func(*args, **kwargs)
+        duration = time.time() - started
+    return {'duration': duration, 'queries': len(context.captured_queries)}
+
+
+def legacy_add_rpms_list(image, nvr_list):
+    """
+    the original per-NVR ingestion, kept here as the baseline
+    """
+    for nvr in nvr_list:
+        rpm = Rpm.objects.get_or_create_from_nvr(nvr)
+        if rpm:
+            rpm_ct = ContentType.objects.get(model='rpm')
+            content, _ = Content.objects.get_or_create(object_id=rpm.id, content_type=rpm_ct)
+            image.content.add(content)
+
+
+@scenario
+def rpm_ingestion(options):
+    """
+    compare per-NVR and bulk RPM ingestion; "cold" run creates all
+    packages, "warm" run stores updates of the already known packages
+    in another image (the same rpms would be just found by digest of
+    their package set)
+    """
+    count = options.get('rpms') or 1000
+    results = OrderedDict()
+    for name, ingest in (('legacy', legacy_add_rpms_list), ('bulk', Image.add_rpms_list)):
+        cold_nvrs = generate_nvrs(count, prefix=name)
+        results[name] = OrderedDict()
+        for run, nvrs in (('cold', cold_nvrs), ('warm', [nvr + '.1' for nvr in cold_nvrs])):
+            image = Image.objects.create(hash='%s-%s' % (name, run))
+            with transaction.atomic():
+                results[name][run] = measure(ingest, image, nvrs)
+            assert len(image.ordered_rpms_list()) == count
+    return results
+
+
+def seed_lookup_data(count):
+    """
+    store count tasks, images, tags, packages and rpms using bulk inserts
+    """
+    task_data = TaskData.objects.create(json='{}')
+    now = timezone.now()
+    Task.objects.bulk_create([
+        Task(celery_id='celery-%d' % i, builddev_id='buildroot-fedora', owner='user%d' % (i % 100),
+             status=i % 4 + 1, type=i % 2 + 1, task_data=task_data,
+             date_finished=now - datetime.timedelta(seconds=i) if i % 4 + 1 > Task.STATUS_RUNNING else None)
+        for i in range(count)
+    ], batch_size=CHUNK_SIZE)
+    Image.objects.bulk_create([
+        Image(hash='%064x' % i, parent_id=i > 100 and '%064x' % (i // 100) or None,
+              status=i % 4 + 1, is_invalidated=i % 50 == 0)
+        for i in range(count)
+    ], batch_size=CHUNK_SIZE)
+    Tag.objects.bulk_create([Tag(name='tag%d' % i) for i in range(count)], batch_size=CHUNK_SIZE)
+    Package.objects.bulk_create([Package(name='package%d' % i) for i in range(count)], batch_size=CHUNK_SIZE)
+    packages = dict(Package.objects.values_list('name', 'id'))
+    Rpm.objects.bulk_create([
+        Rpm(package_id=packages['package%d' % i], nvr='package%d-1.0-1.fc21' % i) for i in range(count)
+    ], batch_size=CHUNK_SIZE)
+
+
+@scenario
+def lookups(options):
+    """
+    time the hot lookups on a seeded dataset (--images, 100000 by default);
+    run it on revisions with and without the indexes to compare
+    """
+    count = options.get('images') or 100000
+    repeat = 50
+    seed_lookup_data(count)
+    queries = OrderedDict((
+        ('task_by_celery_id', lambda i: Task.objects.filter(celery_id='celery-%d' % (i * 7919 % count)).exists()),
+        ('tasks_by_status', lambda i: list(Task.objects.filter(status=Task.STATUS_RUNNING)
+                                           .order_by('-date_finished', '-id')[:50])),
+        ('tasks_by_owner', lambda i: list(Task.objects.filter(owner='user%d' % (i % 100))
+                                          .order_by('-date_finished', '-id')[:50])),
+        ('tag_by_name', lambda i: Tag.objects.filter(name='tag%d' % (i * 7919 % count)).exists()),
+        ('package_by_name', lambda i: Package.objects.filter(name='package%d' % (i * 7919 % count)).exists()),
+        ('rpm_by_nvr', lambda i: Rpm.objects.filter(nvr='package%d-1.0-1.fc21' % (i * 7919 % count)).exists()),
+        ('invalidated_images', lambda i: list(Image.objects.filter(is_invalidated=True)
+                                              .values_list('hash', flat=True)[:50])),
+    ))
+    results = OrderedDict()
+    for name, query in queries.items():
+        started = time.time()
+        for i in range(repeat):
+            query(i)
+        results[name] = {'avg_ms': (time.time() - started) / repeat * 1000}
+    return results
+
+
+def summarize(durations):
+    """
+    return dict with count, mean, median and 95th percentile of durations in milliseconds
+    """
+    durations = sorted(durations)
+    count = len(durations)
+    if not count:
+        return {'count': 0}
+    return OrderedDict((
+        ('count', count),
+        ('avg_ms', sum(durations) / count * 1000),
+        ('p50_ms', durations[max(int(math.ceil(0.5 * count)) - 1, 0)] * 1000),
+        ('p95_ms', durations[max(int(math.ceil(0.95 * count)) - 1, 0)] * 1000),
+    ))
+
+
+def history_options(options):
+    return OrderedDict((
+        ('bases', options.get('bases') or 3),
+        ('depth', options.get('depth') or 3),
+        ('fanout', options.get('fanout') or 3),
+        ('rpms', options.get('rpms') or 300),
+    ))
+
+
+def generate_history(bases, depth, fanout, rpms, ingest=None):
+    """
+    store synthetic build history through new_image_callback: bases base images,
+    each with a tree of built images of given depth and fanout; base images
+    contain rpms packages, every built image adds a tenth of that on top of its parent
+
+    :param ingest: function(task_id, build_results) used to store builds,
+                   new_image_callback by default
+    :return: tuple (list of base image ids, list of durations of ingestion of builds)
+    """
+    from .api.core import new_image_callback
+    ingest = ingest or new_image_callback
+    own_rpms = max(rpms // 10, 1)
+    durations = []
+    base_ids = []
+    for base in range(bases):
+        base_id = '%064x' % (base + 1)
+        base_ids.append(base_id)
+        # packages of base images differ in versions
+        generation = [(base_id, ['%s-%d' % (nvr, base) for nvr in generate_nvrs(rpms)])]
+        for level in range(depth):
+            children = []
+            for parent_id, parent_rpms in generation:
+                for child in range(fanout):
+                    image_id = hashlib.sha256(('%s-%d' % (parent_id, child)).encode('utf-8')).hexdigest()
+                    image_rpms = parent_rpms + generate_nvrs(own_rpms, prefix='%s-%d-' % (image_id[:8], child))
+                    task_data = TaskData.objects.create(json=json.dumps({
+                        'git_url': 'https://example.com/images/%s.git' % image_id[:12],
+                        'git_commit': image_id[:40],
+                        'tag': 'image-%s' % image_id[:12],
+                    }))
+                    task = Task.objects.create(builddev_id='buildroot-fedora', status=Task.STATUS_RUNNING,
+                                               type=Task.TYPE_BUILD, owner='user%d' % (child % 10),
+                                               task_data=task_data)
+                    results = SyntheticBuildResults(image_id, parent_id, image_rpms, parent_rpms,
+                                                    tags=['image-%s' % image_id[:12]])
+                    started = time.time()
+                    ingest(task.id, results)
+                    durations.append(time.time() - started)
+                    children.append((image_id, image_rpms))
+            generation = children
+    return base_ids, durations
+
+
+@scenario
+def history_ingestion(options):
+    """
+    store synthetic build history (--bases, --depth, --fanout, --rpms)
+    through new_image_callback and time every build
+    """
+    params = history_options(options)
+    reset_queries()
+    with CaptureQueriesContext(connection) as context:
+        started = time.time()
+        _, durations = generate_history(**params)
+        duration = time.time() - started
+    results = OrderedDict((('history', params), ('duration', duration),
+                           ('queries', len(context.captured_queries))))
+    results['builds'] = summarize(durations)
+    return results
+
+
+@scenario
+def invalidate(options):
+    """
+    time invalidation of whole trees of synthetic build history
+    """
+    base_ids, _ = generate_history(**history_options(options))
+    durations = []
+    queries = 0
+    for base_id in base_ids:
+        result = measure(Image.objects.invalidate, base_id)
+        durations.append(result['duration'])
+        queries += result['queries']
+    results = summarize(durations)
+    results['queries'] = queries / len(base_ids)
+    return results
+
+
+@scenario
+def api_reads(options):
+    """
+    time API calls and web lists (--repeat times) on synthetic build history;
+    response cache is cleared before every request
+    """
+    from django.core.cache import caches
+    from django.test import Client
+    repeat = options.get('repeat') or 20
+    base_ids, _ = generate_history(**history_options(options))
+    leaf_id = Image.objects.filter(task__isnull=False).order_by('-task').values_list('hash', flat=True)[0]
+    client = Client()
+    urls = OrderedDict((
+        ('image_deps', '/v1/image/%s/deps' % base_ids[0]),
+        ('image_info', '/v1/image/%s/info' % leaf_id),
+        ('list_images', '/v1/images'),
+        ('list_tasks', '/v1/tasks'),
+        ('web_images', '/images/'),
+        ('web_tasks', '/tasks/'),
+        ('web_images_data', '/images/data/?draw=1&start=0&length=50&order[0][column]=0&order[0][dir]=asc'),
+        ('web_tasks_data', '/tasks/data/?draw=1&start=0&length=50&order[0][column]=3&order[0][dir]=desc'),
+    ))
+    results = OrderedDict()
+    for name, url in urls.items():
+        durations = []
+        queries = 0
+        size = 0
+        for i in range(repeat):
+            caches[settings.DBS_API_CACHE].clear()
+            reset_queries()
+            with CaptureQueriesContext(connection) as context:
+                started = time.time()
+                response = client.get(url)
+                durations.append(time.time() - started)
+            assert response.status_code == 200, (url, response.status_code)
+            queries += len(context.captured_queries)
+            size += len(response.content)
+        results[name] = summarize(durations)
+        results[name]['queries'] = queries / repeat
+        results[name]['size'] = size // repeat
+    return results
+
+
+@scenario
+@threaded
+def build_throughput(options):
+    """
+    submit --builds builds (200 by default) through TaskApi from --concurrency
+    threads; celery tasks run eagerly in the submitting threads with the
+    simulated build backend (--build-duration seconds per build, --failure-rate)
+    and their results are stored by the result dispatcher and new_image_callback
+    """
+    from django.db.models import Count
+    from django.test.utils import override_settings
+    from multiprocessing.pool import ThreadPool
+    from .api.core import new_build_kwargs, new_build_task
+    from .celery import app
+    from .dispatcher import get_dispatcher
+    from .task_api import TaskApi
+    count = options.get('builds') or 200
+    concurrency = options.get('concurrency') or 8
+    build_duration = options.get('build_duration') or 0.1
+    backend = OrderedDict((
+        ('build_duration', (build_duration / 2, build_duration * 3 / 2)),
+        ('pull_duration', (0.0, build_duration / 10)),
+        ('push_duration', (0.0, build_duration / 10)),
+        ('failure_rate', options.get('failure_rate') or 0.0),
+    ))
+    builder_api = TaskApi()
+
+    def submit(i):
+        try:
+            data = {
+                'git_url': 'https://example.com/images/image%d.git' % (i % 50),
+                'git_commit': hashlib.sha1(('commit-%d' % i).encode('utf-8')).hexdigest(),
+                'git_dockerfile_path': None,
+                'parent_registry': None,
+                'target_registries': [],
+                'tag': 'image%d' % i,
+                'repos': [],
+            }
+            task = new_build_task('user%d' % (i % 10), TaskData.objects.create(json=json.dumps(data)))
+            task.save()
+            builder_api.build_docker_image(**new_build_kwargs(data, task.owner, task))
+        finally:
+            # every thread has its own connection
+            connection.close()
+
+    always_eager = app.conf.CELERY_ALWAYS_EAGER
+    app.conf.CELERY_ALWAYS_EAGER = True
+    try:
+        with override_settings(DBS_BUILD_BACKEND='dbs.backends.simulated.SimulatedBackend',
+                               DBS_SIMULATED_BACKEND=backend):
+            pool = ThreadPool(concurrency)
+            started = time.time()
+            try:
+                pool.map(submit, range(count))
+            finally:
+                pool.close()
+                pool.join()
+            idle = get_dispatcher().wait(timeout=600)
+            duration = time.time() - started
+    finally:
+        app.conf.CELERY_ALWAYS_EAGER = always_eager
+    statuses = dict(Task.objects.values_list('status').annotate(count=Count('id')))
+    return OrderedDict((
+        ('builds', count),
+        ('concurrency', concurrency),
+        ('backend', backend),
+        ('finished', idle),
+        ('duration', duration),
+        ('builds_per_second', count / duration),
+        ('statuses', dict((name, statuses.get(status, 0)) for status, name in Task._STATUS_NAMES.items())),
+        ('phases', TaskTiming.objects.percentiles()),
+        ('dispatcher', get_dispatcher().stats()),
+    ))
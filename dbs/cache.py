@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+
+from .utils import chunks
+
+__all__ = ('image_cache', )
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache(object):
+    """
+    read-through cache of API responses describing images
+
+    every image has its own version stored in the database (Image.version);
+    entries are keyed by image hash, version and kind of the response, so
+    evicting all entries of an image means just increasing its version;
+    all processes agree on the version even if they do not share the cache
+    backend
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hits = {}
+        self._misses = {}
+
+    @property
+    def cache(self):
+        return caches[settings.DBS_API_CACHE]
+
+    def _count(self, counters, kind):
+        with self._lock:
+            counters[kind] = counters.get(kind, 0) + 1
+
+    def get_version(self, image_id):
+        """
+        return version of image, which changes whenever responses
+        of the image are evicted, None if there is no such image
+        """
+        # models use the cache, import them lazily
+        from .models import Image
+        versions = list(Image.objects.filter(hash=image_id).values_list('version', flat=True)[:1])
+        return versions[0] if versions else None
+
+    def get_or_set(self, image_id, kind, func):
+        """
+        return cached response or compute it by func and cache it
+
+        :param image_id: hash of the image the response describes
+        :param kind: name of the response, e.g. 'info'
+        :param func: function without arguments returning the response
+        """
+        version = self.get_version(image_id)
+        if version is None:
+            # func reports the missing image
+            return func()
+        key = 'dbs:image:%s:%s:%s' % (image_id, version, kind)
+        response = self.cache.get(key)
+        if response is None:
+            self._count(self._misses, kind.split(':')[0])
+            response = func()
+            self.cache.set(key, response, settings.DBS_API_CACHE_TIMEOUT)
+        else:
+            self._count(self._hits, kind.split(':')[0])
+        return response
+
+    def evict(self, image_ids):
+        """
+        drop all cached responses of provided images
+        """
+        from .models import CHUNK_SIZE, Image
+        image_ids = sorted(set(image_ids))
+        if image_ids:
+            logger.debug('evicting %d images from cache', len(image_ids))
+            for chunk in chunks(image_ids, CHUNK_SIZE):
+                Image.objects.filter(hash__in=chunk).update(version=F('version') + 1)
+
+    def stats(self):
+        """
+        return dict with numbers of hits and misses by kind of response
+        """
+        with self._lock:
+            return {
+                'hits': dict(self._hits),
+                'misses': dict(self._misses),
+            }
+
+
+image_cache = ImageCache()
@@ -1,14 +1,13 @@
 from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
-from django.core.exceptions import ObjectDoesNotExist
 
 import os
 import logging
-import time
 
 from celery import Celery
 from celery.signals import task_prerun
 
 from django.conf import settings
+from django.utils import timezone
 
 
 logger = logging.getLogger(__name__)
@@ -33,20 +32,21 @@ def debug_task(self):
 @task_prerun.connect
 def task_sent_handler(**kwargs):
     logger.info("kwargs = %s", kwargs)
-    # broker is quicker than relational DB so this usually gets executed sooner than we have
-    # celery task in DB, this suspend could solve it
-    time.sleep(1)
+    # celery_id of Task is stored before the celery task is sent,
+    # so the record is always available here
     try:
         task_id = kwargs['task_id']
     except KeyError:
         logger.error("missing task_id in kwargs")
     else:
-        from dbs.models import Task
-        try:
-            task = Task.objects.get(celery_id=task_id)
-        except ObjectDoesNotExist:
-            logger.error("No such task '%s'", task_id)
+        from dbs.models import Task, TaskTiming
+        pending = Task.objects.filter(celery_id=task_id, status=Task.STATUS_PENDING)
+        tasks = list(pending.values_list('id', 'date_started'))
+        updated = pending.update(status=Task.STATUS_RUNNING)
+        if not updated:
+            logger.debug("No pending task '%s'", task_id)
         else:
-            task.state = Task.STATUS_RUNNING
-            task.save()
-
+            # date_started is the time the task was sent
+            for pk, date_started in tasks:
+                TaskTiming.objects.create(task_id=pk, phase=TaskTiming.PHASE_QUEUE_WAIT,
+                                          duration=(timezone.now() - date_started).total_seconds())
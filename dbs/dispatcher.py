@@ -0,0 +1,161 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.six.moves import queue
+
+__all__ = ('ResultDispatcher', 'get_dispatcher')
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResultDispatcher(object):
+    """
+    watch results of celery tasks from a single thread and execute
+    callbacks of finished tasks in a bounded pool of worker threads:
+
+        callback(response, **kwargs)
+
+    where response is a result of task (None if the task failed)
+    """
+
+    def __init__(self, workers=4, poll_interval=1.0, queue_size=1000):
+        """
+        :param workers: number of threads executing callbacks
+        :param poll_interval: seconds between two checks of watched results
+        :param queue_size: maximal number of finished tasks waiting for a worker,
+                           the monitor stops polling when the queue is full
+        """
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._started = False
+        self._running = 0
+        self._callbacks_total = 0
+        self._callbacks_failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def watch(self, task_result, callback, kwargs=None):
+        """
+        execute callback when task finishes
+
+        :param task_result: AsyncResult of the task
+        :param callback: function which is called when task finishes
+        :param kwargs: dict which is passed to callback
+        """
+        with self._lock:
+            self._watched[task_result.task_id] = (task_result, callback, kwargs)
+            if not self._started:
+                self._start()
+
+    def _start(self):
+        threads = [threading.Thread(target=self._monitor, name='dispatcher-monitor')]
+        threads.extend(threading.Thread(target=self._work, name='dispatcher-worker-%d' % i)
+                       for i in range(self.workers))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self._started = True
+
+    def _monitor(self):
+        while True:
+            with self._lock:
+                watched = list(self._watched.items())
+            for task_id, item in watched:
+                try:
+                    ready = item[0].ready()
+                except Exception:
+                    logger.exception('Failed to get state of task %s', task_id)
+                    continue
+                if ready:
+                    self._queue.put((item, time.time()))
+                    with self._lock:
+                        del self._watched[task_id]
+            time.sleep(self.poll_interval)
+
+    def _work(self):
+        while True:
+            (task_result, callback, kwargs), finished = self._queue.get()
+            with self._lock:
+                self._running += 1
+            failed = False
+            try:
+                # the task is finished, its result is available without waiting
+                response = task_result.result
+                if task_result.failed():
+                    logger.error('Task %s failed: %r', task_result.task_id, response)
+                    response = None
+                callback(response, **(kwargs or {}))
+            except Exception:
+                failed = True
+                logger.exception('Callback of task %s failed', task_result.task_id)
+            finally:
+                # callbacks use the database from this thread
+                close_old_connections()
+                latency = time.time() - finished
+                with self._lock:
+                    self._running -= 1
+                    self._callbacks_total += 1
+                    self._callbacks_failed += failed
+                    self._latency_total += latency
+                    self._latency_max = max(self._latency_max, latency)
+                self._queue.task_done()
+
+    def wait(self, timeout=None):
+        """
+        block until all watched tasks finish and their callbacks are executed
+
+        :param timeout: maximal number of seconds to wait
+        :return: True if dispatcher is idle, False on timeout
+        """
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            with self._lock:
+                if not self._watched and not self._running and self._queue.empty():
+                    return True
+            if deadline and time.time() > deadline:
+                return False
+            time.sleep(min(self.poll_interval, 0.1))
+
+    def stats(self):
+        """
+        return dict with current queue depth and callback latency
+        """
+        with self._lock:
+            return {
+                'watched': len(self._watched),
+                'queue_depth': self._queue.qsize(),
+                'running': self._running,
+                'workers': self.workers,
+                'callbacks_total': self._callbacks_total,
+                'callbacks_failed': self._callbacks_failed,
+                'callback_latency_avg': self._callbacks_total and self._latency_total / self._callbacks_total,
+                'callback_latency_max': self._latency_max,
+            }
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """
+    return dispatcher of this process configured by settings
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = ResultDispatcher(
+                workers=settings.DBS_DISPATCHER_WORKERS,
+                poll_interval=settings.DBS_DISPATCHER_POLL_INTERVAL,
+                queue_size=settings.DBS_DISPATCHER_QUEUE_SIZE,
+            )
+        return _dispatcher
@@ -0,0 +1,184 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+__all__ = ('WorkerImageCache', 'get_worker_image_cache')
+
+
+logger = logging.getLogger(__name__)
+
+
+def split_image_name(image):
+    """
+    return tuple (repository, tag) of image name, tag defaults to latest
+    """
+    repository, _, tag = image.rpartition(':')
+    if not repository or '/' in tag:
+        # no tag, the colon belongs to registry address
+        return image, 'latest'
+    return repository, tag
+
+
+class WorkerImageCache(object):
+    """
+    keep track of images pulled by the worker, so they are pulled only
+    when they changed in the registry
+
+    State of the cache is stored in a json file shared by all worker
+    processes of the host:
+
+        {local image name: {"digest": ..., "size": ..., "last_used": ...}}
+
+    When the tracked images take more than budget bytes, least recently used
+    images are removed from docker.
+    """
+    def __init__(self, state_path, budget, docker_url):
+        import docker
+        self.docker = docker.Client(base_url=docker_url)
+        self.state_path = state_path
+        self.budget = budget
+
+    @contextmanager
+    def _state(self):
+        """
+        lock the state file and yield state, which is saved on exit
+        """
+        with open(self.state_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.state_path) as f:
+                        state = json.load(f)
+                except (IOError, ValueError):
+                    state = {}
+                yield state
+                with open(self.state_path + '.tmp', 'w') as f:
+                    json.dump(state, f)
+                os.rename(self.state_path + '.tmp', self.state_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def remote_version(self, registry, image):
+        """
+        return version of image in registry: digest of its manifest (v2 API)
+        or id of the image (v1 API, which has no digests), None if it can
+        not be found out
+        """
+        import requests
+        repository, tag = split_image_name(image)
+        v1_repository = repository if '/' in repository else 'library/' + repository
+        for scheme in ('https', 'http'):
+            base_url = '%s://%s' % (scheme, registry)
+            try:
+                response = requests.head('%s/v2/%s/manifests/%s' % (base_url, repository, tag), timeout=10, headers={
+                    'Accept': 'application/vnd.docker.distribution.manifest.v2+json',
+                })
+                if response.ok and response.headers.get('Docker-Content-Digest'):
+                    return response.headers['Docker-Content-Digest']
+                response = requests.get('%s/v1/repositories/%s/tags/%s' % (base_url, v1_repository, tag), timeout=10)
+            except requests.RequestException:
+                continue
+            if response.ok:
+                try:
+                    return response.json()
+                except ValueError:
+                    return None
+            return None
+        return None
+
+    def local_image(self, name):
+        """
+        return result of docker inspect of image, None if it is not present
+        """
+        import docker
+        try:
+            return self.docker.inspect_image(name)
+        except docker.errors.APIError:
+            return None
+
+    def pull(self, image, registry=None):
+        """
+        make sure that current version of image from registry is present
+
+        Image which is present and has the same version as in the registry
+        (digest recorded when it was pulled, or its id for v1 registries)
+        is not pulled again. Image without registry is never pulled, it has
+        to be present already (e.g. build image loaded by the admin).
+
+        :return: dict with name of the local image, hit (True if nothing
+                 was pulled) and duration in seconds
+        """
+        started = time.time()
+        name = '%s/%s' % (registry, image) if registry else image
+        present = self.local_image(name)
+        if registry:
+            version = self.remote_version(registry, image)
+            with self._state() as state:
+                entry = state.get(name) or {}
+            hit = bool(present and version and version in (present.get('Id'), entry.get('digest')))
+        else:
+            if present is None:
+                raise RuntimeError('Image %s is not present and there is no registry to pull it from' % name)
+            version = None
+            hit = True
+        if not hit:
+            repository, tag = split_image_name(name)
+            logger.info('pulling %s:%s', repository, tag)
+            self.docker.pull(repository, tag=tag, insecure_registry=True)
+            present = self.local_image(name)
+            if present is None:
+                raise RuntimeError('Failed to pull image %s' % name)
+        with self._state() as state:
+            state[name] = {
+                'digest': version,
+                'size': present.get('VirtualSize') or present.get('Size') or 0,
+                'last_used': time.time(),
+            }
+            self._evict(state, keep=name)
+        logger.info('image cache %s: %s', 'hit' if hit else 'miss', name)
+        return {'image': name, 'hit': hit, 'duration': time.time() - started}
+
+    def _evict(self, state, keep):
+        """
+        remove least recently used images until the rest fits into budget
+        """
+        used = sum(entry['size'] for entry in state.values())
+        for name, entry in sorted(state.items(), key=lambda item: item[1]['last_used']):
+            if used <= self.budget:
+                break
+            if name == keep:
+                continue
+            try:
+                self.docker.remove_image(name)
+            except Exception as ex:
+                # e.g. image used by a running container
+                logger.warning('failed to evict image %s: %r', name, ex)
+                continue
+            logger.info('evicted image %s (%d bytes)', name, entry['size'])
+            used -= entry['size']
+            del state[name]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_worker_image_cache():
+    """
+    return WorkerImageCache configured by DBS_WORKER_IMAGE_CACHE_* settings
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = WorkerImageCache(settings.DBS_WORKER_IMAGE_CACHE_STATE,
+                                      settings.DBS_WORKER_IMAGE_CACHE_BUDGET,
+                                      settings.DBS_WORKER_DOCKER_URL)
+        return _cache
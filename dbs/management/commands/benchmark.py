@@ -0,0 +1,89 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import json
+import time
+from collections import OrderedDict
+from optparse import make_option
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from ...benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    args = '[scenario ...]'
+    help = 'Run benchmark scenarios against a temporary test database and print results as JSON. ' \
+           'Every scenario starts with an empty database. ' \
+           'Available scenarios: {}.'.format(', '.join(SCENARIOS))
+    option_list = BaseCommand.option_list + (
+        make_option('--rpms', type='int', dest='rpms',
+                    help='Number of RPMs per image.'),
+        make_option('--images', type='int', dest='images',
+                    help='Number of images (and other records) to seed.'),
+        make_option('--bases', type='int', dest='bases',
+                    help='Number of base images of synthetic build history.'),
+        make_option('--depth', type='int', dest='depth',
+                    help='Number of generations of images built on every base image.'),
+        make_option('--fanout', type='int', dest='fanout',
+                    help='Number of images built on every image.'),
+        make_option('--repeat', type='int', dest='repeat',
+                    help='Number of repetitions of timed requests.'),
+        make_option('--builds', type='int', dest='builds',
+                    help='Number of simulated builds.'),
+        make_option('--concurrency', type='int', dest='concurrency',
+                    help='Number of simulated builds running at once.'),
+        make_option('--build-duration', type='float', dest='build_duration',
+                    help='Average number of seconds a simulated build takes.'),
+        make_option('--failure-rate', type='float', dest='failure_rate',
+                    help='Fraction of simulated builds which fail.'),
+        make_option('--output', dest='output',
+                    help='Write results also into this file.'),
+    )
+
+    def handle(self, *args, **options):
+        names = args or list(SCENARIOS)
+        for name in names:
+            if name not in SCENARIOS:
+                raise CommandError('Unknown scenario: {}'.format(name))
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = OrderedDict()
+            for name in names:
+                scenario = SCENARIOS[name]
+                if not getattr(scenario, 'threaded', False):
+                    with transaction.atomic():
+                        results[name] = scenario(options)
+                        # leave empty database for the next scenario
+                        transaction.set_rollback(True)
+                elif connection.vendor == 'sqlite' and connection.settings_dict['NAME'] == ':memory:':
+                    # every thread would get its own empty database
+                    results[name] = {'error': 'in-memory SQLite database can not be shared by threads, '
+                                              'set TEST NAME of the database to a file'}
+                else:
+                    try:
+                        results[name] = scenario(options)
+                    finally:
+                        call_command('flush', interactive=False, verbosity=0)
+                caches[settings.DBS_API_CACHE].clear()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        report = OrderedDict((
+            ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('database', connection.vendor),
+            ('django', django.get_version()),
+            ('options', dict((key, options.get(key)) for key in
+                             ('rpms', 'images', 'bases', 'depth', 'fanout', 'repeat',
+                              'builds', 'concurrency', 'build_duration', 'failure_rate'))),
+            ('results', results),
+        ))
+        output = json.dumps(report, indent=4)
+        if options.get('output'):
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
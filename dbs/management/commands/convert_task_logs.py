@@ -0,0 +1,42 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import io
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import TaskLogChunk
+
+
+class Command(BaseCommand):
+    args = '<input.json> <output.json>'
+    help = 'Convert a data dump with logs stored in the "log" field of tasks (before log chunks ' \
+           'were introduced) into a dump which can be loaded into the current schema.'
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: convert_task_logs {}'.format(self.args))
+        with io.open(args[0], encoding='utf-8') as f:
+            objects = json.load(f)
+        converted = []
+        tasks = 0
+        for obj in objects:
+            converted.append(obj)
+            if obj.get('model') != 'dbs.task':
+                continue
+            log = obj['fields'].pop('log', None)
+            if not log:
+                continue
+            tasks += 1
+            converted.extend({
+                'model': 'dbs.tasklogchunk',
+                'fields': {
+                    'task': obj['pk'],
+                    'offset': offset,
+                    'end': offset + len(log[offset:offset + TaskLogChunk.SIZE]),
+                    'data': log[offset:offset + TaskLogChunk.SIZE],
+                },
+            } for offset in range(0, len(log), TaskLogChunk.SIZE))
+        with io.open(args[1], 'w', encoding='utf-8') as f:
+            f.write(json.dumps(converted, indent=4, ensure_ascii=False))
+        self.stdout.write('Converted logs of {} tasks.'.format(tasks))
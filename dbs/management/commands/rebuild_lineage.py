@@ -0,0 +1,13 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+from django.core.management.base import BaseCommand
+
+from ...models import ImageLineage
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the image lineage index from the parent links of all images.'
+
+    def handle(self, *args, **options):
+        count = ImageLineage.objects.rebuild()
+        self.stdout.write('Stored {} lineage records.'.format(count))
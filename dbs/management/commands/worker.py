@@ -0,0 +1,47 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...celery import app
+
+
+class Command(BaseCommand):
+    args = '<profile>'
+    help = 'Start celery worker consuming queues of one worker profile. ' \
+           'Available profiles: {}.'.format(', '.join(sorted(settings.DBS_WORKER_PROFILES)))
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', '-c', type='int', dest='concurrency',
+                    help='Number of worker processes (default is given by the profile).'),
+        make_option('--prefetch-multiplier', type='int', dest='prefetch_multiplier',
+                    help='Number of tasks reserved per process (default is given by the profile).'),
+        make_option('--loglevel', '-l', dest='loglevel', default='INFO',
+                    help='Logging level.'),
+        make_option('--hostname', '-n', dest='hostname',
+                    help='Node name of the worker (default is <profile>@<host>).'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Exactly one profile is required.')
+        name = args[0]
+        try:
+            profile = settings.DBS_WORKER_PROFILES[name]
+        except KeyError:
+            raise CommandError('Unknown profile: {}'.format(name))
+        concurrency = options['concurrency'] or profile['concurrency']
+        prefetch_multiplier = options['prefetch_multiplier'] or profile['prefetch_multiplier']
+        app.conf.CELERYD_PREFETCH_MULTIPLIER = prefetch_multiplier
+        argv = [
+            'worker',
+            '--queues', ','.join(profile['queues']),
+            '--concurrency', str(concurrency),
+            '--loglevel', options['loglevel'],
+            '--hostname', options['hostname'] or '{}@%h'.format(name),
+        ]
+        if prefetch_multiplier == 1:
+            # send tasks only to idle processes of the worker
+            argv.extend(['-O', 'fair'])
+        app.worker_main(argv)
@@ -0,0 +1,226 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.core.urlresolvers import get_resolver
+from django.db.backends import utils
+
+__all__ = ('Histogram', 'MetricsMiddleware', 'metrics', 'observe_serialization')
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def format_labels(labels):
+    """
+    return labels (tuple of (name, value) pairs) in Prometheus text format
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, ('%s' % value).replace('\\', '\\\\').replace('"', '\\"')
+                                                 .replace('\n', '\\n'))
+                             for name, value in labels)
+
+
+class Histogram(object):
+    """
+    thread-safe in-process histogram with labels
+    """
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> [counts by bucket (the last one is +Inf), sum]
+        self._series = {}
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (self.name, format_labels(labels), cumulative))
+        return lines
+
+
+class Metrics(object):
+    """
+    request metrics of this process
+    """
+    def __init__(self):
+        self.duration = Histogram('dbs_http_request_duration_seconds',
+                                  'Wall time of requests.', DURATION_BUCKETS)
+        self.queries = Histogram('dbs_http_request_db_queries',
+                                 'Number of database queries per request.', COUNT_BUCKETS)
+        self.query_duration = Histogram('dbs_http_request_db_duration_seconds',
+                                        'Time spent in database queries per request.', DURATION_BUCKETS)
+        self.serialization = Histogram('dbs_http_response_serialization_seconds',
+                                       'Time spent serializing JSON responses.', DURATION_BUCKETS)
+        self.size = Histogram('dbs_http_response_size_bytes',
+                              'Size of response bodies.', SIZE_BUCKETS)
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)
+
+    def observe_request(self, labels, status, stats, size):
+        self.duration.observe(labels, time.time() - stats.started)
+        self.queries.observe(labels, stats.queries)
+        self.query_duration.observe(labels, stats.query_duration)
+        if stats.serialization is not None:
+            self.serialization.observe(labels, stats.serialization)
+        if size is not None:
+            self.size.observe(labels, size)
+        with self._lock:
+            self._requests[labels + (('status', status),)] += 1
+
+    def render(self, gauges=()):
+        """
+        return all metrics in Prometheus text format
+
+        :param gauges: iterable of (name, help, labels, value) added to the output
+        """
+        lines = ['# HELP dbs_http_requests_total Number of requests.', '# TYPE dbs_http_requests_total counter']
+        with self._lock:
+            requests = sorted(self._requests.items())
+        lines.extend('dbs_http_requests_total%s %d' % (format_labels(labels), count) for labels, count in requests)
+        for histogram in (self.duration, self.queries, self.query_duration, self.serialization, self.size):
+            lines.extend(histogram.render())
+        described = set()
+        for name, help, labels, value in gauges:
+            if name not in described:
+                lines.extend(['# HELP %s %s' % (name, help), '# TYPE %s gauge' % name])
+                described.add(name)
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class RequestStats(object):
+    """
+    counters of a request being processed by the current thread
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.labels = None
+        self.queries = 0
+        self.query_duration = 0.0
+        self.serialization = None
+
+
+_local = threading.local()
+
+
+def current_stats():
+    """
+    return RequestStats of request processed by this thread, None outside of requests
+    """
+    return getattr(_local, 'stats', None)
+
+
+def observe_serialization(duration):
+    stats = current_stats()
+    if stats is not None:
+        stats.serialization = (stats.serialization or 0.0) + duration
+
+
+def _instrument(method):
+    def instrumented(self, *args, **kwargs):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return method(self, *args, **kwargs)
+        started = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stats.queries += 1
+            stats.query_duration += time.time() - started
+    instrumented.instrumented = True
+    return instrumented
+
+
+def install_cursor_instrumentation():
+    """
+    count queries and their duration in all database cursors
+    """
+    for name in ('execute', 'executemany'):
+        method = getattr(utils.CursorWrapper, name)
+        if not getattr(method, 'instrumented', False):
+            setattr(utils.CursorWrapper, name, _instrument(method))
+
+
+_patterns = {}
+_patterns_lock = threading.Lock()
+
+
+def _collect_patterns(resolver, prefix, patterns):
+    for pattern in resolver.url_patterns:
+        regex = prefix + pattern.regex.pattern.lstrip('^')
+        if hasattr(pattern, 'url_patterns'):
+            _collect_patterns(pattern, regex.rstrip('$'), patterns)
+        else:
+            patterns.setdefault(pattern.callback, '^' + regex)
+
+
+def url_pattern(view_func):
+    """
+    return URL pattern routed to view_func
+    """
+    with _patterns_lock:
+        if not _patterns:
+            _collect_patterns(get_resolver(None), '', _patterns)
+        return _patterns.get(view_func, '')
+
+
+class MetricsMiddleware(object):
+    """
+    record wall time, number and time of database queries, time of JSON
+    serialization and size of response of every request by view
+    """
+    def __init__(self):
+        install_cursor_instrumentation()
+
+    def process_request(self, request):
+        _local.stats = RequestStats()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = current_stats()
+        if stats is not None:
+            stats.labels = (
+                ('view', '%s.%s' % (view_func.__module__, view_func.__name__)),
+                ('pattern', url_pattern(view_func)),
+                ('method', request.method),
+            )
+
+    def process_response(self, request, response):
+        stats = current_stats()
+        _local.stats = None
+        if stats is not None and stats.labels is not None:
+            size = None if getattr(response, 'streaming', False) else len(response.content)
+            try:
+                metrics.observe_request(stats.labels, response.status_code, stats, size)
+            except Exception:
+                logger.exception('Failed to record metrics of %s', request.path)
+        return response
@@ -1,18 +1,46 @@
 from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
 
+import hashlib
 import json
+import math
 import re
 import logging
 import socket
+from datetime import timedelta
 
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+from .cache import image_cache
+from .utils import chunks
 
 
 logger = logging.getLogger(__name__)
 
+# keep the number of SQL parameters per statement below SQLite's limit
+CHUNK_SIZE = 500
+
+
+def bulk_create_or_skip(queryset, objects, unique_field):
+    """
+    bulk_create objects; if some of them were created concurrently
+    (unique_field clashes), create the rest one by one
+    """
+    try:
+        with transaction.atomic():
+            queryset.bulk_create(objects, batch_size=CHUNK_SIZE)
+    except IntegrityError:
+        for obj in objects:
+            queryset.get_or_create(defaults=dict(
+                (field.attname, getattr(obj, field.attname)) for field in obj._meta.concrete_fields
+                if not field.primary_key
+            ), **{unique_field: getattr(obj, unique_field)})
+
+
 
 class TaskData(models.Model):
     json = models.TextField()
@@ -22,6 +50,29 @@ class TaskData(models.Model):
 
 
 
+class TaskQuerySet(models.QuerySet):
+    def reusable(self, fingerprints):
+        """
+        find builds which may be reused instead of new builds with given
+        fingerprints: the latest build which is still in progress or
+        whose image was not invalidated; builds in progress for longer
+        than DBS_TASK_TIMEOUT are considered lost and are not reused
+
+        :return: dict {fingerprint: Task}
+        """
+        tasks = {}
+        started_after = timezone.now() - timedelta(seconds=settings.DBS_TASK_TIMEOUT)
+        for chunk in chunks(list(fingerprints), CHUNK_SIZE):
+            for task in self.filter(fingerprint__in=chunk, type=Task.TYPE_BUILD).filter(
+                models.Q(status__in=(Task.STATUS_PENDING, Task.STATUS_RUNNING),
+                         date_finished__isnull=True, date_started__gte=started_after) |
+                models.Q(status=Task.STATUS_SUCCESS, image__is_invalidated=False)
+            ).select_related('image').order_by('-id'):
+                tasks.setdefault(task.fingerprint, task)
+        return tasks
+
+
+
 class Task(models.Model):
     STATUS_PENDING  = 1
     STATUS_RUNNING  = 2
@@ -41,18 +92,28 @@ class Task(models.Model):
         TYPE_MOVE:  'Move',
     }
 
-    celery_id       = models.CharField(max_length=42, blank=True, null=True)
+    celery_id       = models.CharField(max_length=42, blank=True, null=True, unique=True)
     date_started    = models.DateTimeField(auto_now_add=True)
-    date_finished   = models.DateTimeField(null=True, blank=True)
+    date_finished   = models.DateTimeField(null=True, blank=True, db_index=True)
     builddev_id     = models.CharField(max_length=38)
-    status          = models.IntegerField(choices=_STATUS_NAMES.items(), default=STATUS_PENDING)
-    type            = models.IntegerField(choices=_TYPE_NAMES.items())
-    owner           = models.CharField(max_length=38)
+    status          = models.IntegerField(choices=_STATUS_NAMES.items(), default=STATUS_PENDING, db_index=True)
+    type            = models.IntegerField(choices=_TYPE_NAMES.items(), db_index=True)
+    owner           = models.CharField(max_length=38, db_index=True)
     task_data       = models.ForeignKey(TaskData)
-    log             = models.TextField(blank=True, null=True)
+    # identifies builds producing identical images, see api.core.build_fingerprint
+    fingerprint     = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    # json with results of the task (e.g. errors and durations of pushes)
+    result          = models.TextField(null=True, blank=True)
+
+    objects = TaskQuerySet.as_manager()
 
     class Meta:
-        ordering = ['-date_finished']
+        # no default ordering, it would force sorting of every query;
+        # listings order by (date_finished, id) explicitly
+        index_together = (
+            ('status', 'date_finished'),
+            ('owner', 'date_finished'),
+        )
 
     def __unicode__(self):
         return "%d [%s]" % (self.id, self.get_status())
@@ -63,6 +124,51 @@ class Task(models.Model):
     def get_status(self):
         return self._STATUS_NAMES[self.status]
 
+    def is_finished(self):
+        return self.status in (self.STATUS_FAILED, self.STATUS_SUCCESS)
+
+    def append_log(self, text):
+        """
+        append text to the log of the task
+        """
+        if not text:
+            return
+        with transaction.atomic():
+            offset = self.log_chunks.aggregate(end=models.Max('end'))['end'] or 0
+            TaskLogChunk.objects.bulk_create([
+                TaskLogChunk(task=self, offset=offset + i, end=offset + i + len(text[i:i + TaskLogChunk.SIZE]),
+                             data=text[i:i + TaskLogChunk.SIZE])
+                for i in range(0, len(text), TaskLogChunk.SIZE)
+            ])
+
+    def read_log(self, offset=0):
+        """
+        return tuple (part of log starting at offset, offset of its end);
+        offsets are positions of characters
+        """
+        chunks = list(self.log_chunks.filter(end__gt=offset).order_by('offset'))
+        if not chunks:
+            return '', offset
+        text = ''.join(chunk.data for chunk in chunks)
+        return text[max(offset - chunks[0].offset, 0):], chunks[-1].end
+
+    @property
+    def log(self):
+        return self.read_log()[0] or None
+
+    def record_timings(self, timings):
+        """
+        store durations of phases of the task
+
+        :param timings: dict {phase: duration in seconds}
+        """
+        TaskTiming.objects.bulk_create([
+            TaskTiming(task=self, phase=phase, duration=duration) for phase, duration in timings.items()
+        ])
+
+    def timings_as_dict(self):
+        return dict(self.timings.values_list('phase', 'duration'))
+
     def __json__(self):
         response = {
             "task_id": self.id,
@@ -74,6 +180,9 @@ class Task(models.Model):
             "builddev-id": self.builddev_id,
         }
 
+        if self.result:
+            response['result'] = json.loads(self.result)
+
         if hasattr(self, 'image'):
             response['image_id'] = self.image.hash
             task_data = json.loads(self.task_data.json)
@@ -85,9 +194,90 @@ class Task(models.Model):
 
 
 
+class PackageQuerySet(models.QuerySet):
+    def bulk_get_or_create(self, names):
+        """
+        return dict {name: package id}, missing packages are created
+
+        :param names: iterable of package names
+        """
+        names = set(names)
+        packages = {}
+        for chunk in chunks(names, CHUNK_SIZE):
+            packages.update(self.filter(name__in=chunk).values_list('name', 'id'))
+        missing = names.difference(packages)
+        if missing:
+            bulk_create_or_skip(self, [Package(name=name) for name in missing], 'name')
+            for chunk in chunks(missing, CHUNK_SIZE):
+                packages.update(self.filter(name__in=chunk).values_list('name', 'id'))
+        return packages
+
+
+
+class TaskTimingQuerySet(models.QuerySet):
+    def percentiles(self, percents=(50, 95)):
+        """
+        return dict {phase: {'count': n, 'p<percent>': duration, ...}}
+        """
+        results = {}
+        for phase in sorted(set(self.values_list('phase', flat=True).distinct())):
+            durations = self.filter(phase=phase).order_by('duration').values_list('duration', flat=True)
+            count = durations.count()
+            results[phase] = {'count': count}
+            for percent in percents:
+                # nearest-rank method
+                results[phase]['p%d' % percent] = durations[max(int(math.ceil(percent / 100 * count)) - 1, 0)]
+        return results
+
+
+
+class TaskTiming(models.Model):
+    """
+    duration of one phase of a task, e.g. waiting in queue or building
+    """
+    PHASE_QUEUE_WAIT    = 'queue_wait'
+    PHASE_PREPARE       = 'prepare'
+    PHASE_BUILD         = 'build'
+    PHASE_PULL          = 'pull'
+    PHASE_PUSH          = 'push'
+    PHASE_INGEST        = 'ingest'
+
+    task            = models.ForeignKey(Task, related_name='timings')
+    phase           = models.CharField(max_length=16)
+    # seconds
+    duration        = models.FloatField()
+    date_recorded   = models.DateTimeField(auto_now_add=True)
+
+    objects = TaskTimingQuerySet.as_manager()
+
+    class Meta:
+        index_together = (
+            ('phase', 'date_recorded'),
+        )
+
+
+
+class TaskLogChunk(models.Model):
+    """
+    part of task log; offset and end are positions (in characters) of the chunk within the log
+    """
+    SIZE = 64 * 1024
+
+    task    = models.ForeignKey(Task, related_name='log_chunks')
+    offset  = models.PositiveIntegerField()
+    end     = models.PositiveIntegerField()
+    data    = models.TextField()
+
+    class Meta:
+        unique_together = (('task', 'offset'),)
+
+
+
 class Package(models.Model):
     """ TODO: software collections """
-    name = models.CharField(max_length=64)
+    name = models.CharField(max_length=64, unique=True)
+
+    objects = PackageQuerySet.as_manager()
 
 
 
@@ -102,11 +292,38 @@ class RpmQuerySet(models.QuerySet):
         else:
             logger.error('"%s" is not an N-V-R', nvr)
 
+    def bulk_get_or_create_from_nvrs(self, nvr_list):
+        """
+        bulk variant of get_or_create_from_nvr
+
+        :param nvr_list: iterable of RPM nvrs
+        :return: dict {nvr: rpm id}, invalid nvrs are left out
+        """
+        package_names = {}
+        for nvr in set(nvr_list):
+            re_nvr = re.match('(.*)-(.*)-(.*)', nvr)
+            if re_nvr:
+                package_names[nvr] = re_nvr.group(1)
+            else:
+                logger.error('"%s" is not an N-V-R', nvr)
+        rpms = {}
+        for chunk in chunks(package_names, CHUNK_SIZE):
+            rpms.update(self.filter(nvr__in=chunk).values_list('nvr', 'id'))
+        missing = set(package_names).difference(rpms)
+        if missing:
+            packages = Package.objects.bulk_get_or_create(package_names[nvr] for nvr in missing)
+            bulk_create_or_skip(self, [
+                Rpm(package_id=packages[package_names[nvr]], nvr=nvr) for nvr in missing
+            ], 'nvr')
+            for chunk in chunks(missing, CHUNK_SIZE):
+                rpms.update(self.filter(nvr__in=chunk).values_list('nvr', 'id'))
+        return rpms
+
 
 
 class Rpm(models.Model):
     package = models.ForeignKey(Package)
-    nvr = models.CharField(max_length=128)
+    nvr = models.CharField(max_length=128, unique=True)
     part_of = GenericRelation('Content')
 
     objects = RpmQuerySet.as_manager()
@@ -126,6 +343,104 @@ class Content(models.Model):
 
 
 
+class PackageSetQuerySet(models.QuerySet):
+    def get_or_create_from_nvrs(self, nvr_list, base=None):
+        """
+        return package set containing exactly the provided rpms
+
+        identical sets are stored only once (they are looked up by digest);
+        a new set is stored as a difference against base, if it is given
+        and the difference is smaller than the set itself
+
+        :param nvr_list: iterable of RPM nvrs
+        :param base: PackageSet
+        :return: PackageSet
+        """
+        rpms = Rpm.objects.bulk_get_or_create_from_nvrs(nvr_list)
+        digest = PackageSet.get_digest(rpms)
+        try:
+            return self.get(digest=digest)
+        except ObjectDoesNotExist:
+            pass
+        rpm_ids = set(rpms.values())
+        added, removed = rpm_ids, set()
+        if base is not None:
+            # deltas are stored only against complete sets
+            if base.base_id is not None:
+                base = base.base
+            base_ids = set(base.members.values_list('rpm_id', flat=True))
+            if len(rpm_ids ^ base_ids) < len(rpm_ids):
+                added, removed = rpm_ids - base_ids, base_ids - rpm_ids
+            else:
+                base = None
+        try:
+            with transaction.atomic():
+                package_set = self.create(digest=digest, base=base, size=len(rpm_ids))
+                PackageSetMember.objects.bulk_create(
+                    [PackageSetMember(package_set=package_set, rpm_id=rpm_id) for rpm_id in added] +
+                    [PackageSetMember(package_set=package_set, rpm_id=rpm_id, removed=True) for rpm_id in removed],
+                    batch_size=CHUNK_SIZE,
+                )
+        except IntegrityError:
+            # somebody else has just stored the same set
+            return self.get(digest=digest)
+        return package_set
+
+    def nvrs_for(self, package_set_ids):
+        """
+        return dict {package set id: ordered list of nvrs}
+        """
+        package_set_ids = set(package_set_ids)
+        bases = {}
+        for chunk in chunks(package_set_ids, CHUNK_SIZE):
+            bases.update(self.filter(id__in=chunk).values_list('id', 'base'))
+        needed = package_set_ids.union(base for base in bases.values() if base is not None)
+        added = dict((package_set_id, set()) for package_set_id in needed)
+        removed = dict((package_set_id, set()) for package_set_id in needed)
+        for chunk in chunks(needed, CHUNK_SIZE):
+            for package_set_id, nvr, is_removed in PackageSetMember.objects \
+                    .filter(package_set__in=chunk).values_list('package_set', 'rpm__nvr', 'removed'):
+                (removed if is_removed else added)[package_set_id].add(nvr)
+        response = {}
+        for package_set_id, base in bases.items():
+            nvrs = added[package_set_id]
+            if base is not None:
+                nvrs = (added[base] - removed[package_set_id]) | nvrs
+            response[package_set_id] = sorted(nvrs)
+        return response
+
+
+
+class PackageSet(models.Model):
+    """
+    content addressed set of rpms shared by all images with the same content;
+    set with base contains only the differences against its base
+    """
+    digest  = models.CharField(max_length=64, unique=True)
+    base    = models.ForeignKey('self', null=True, blank=True)
+    size    = models.PositiveIntegerField()
+
+    objects = PackageSetQuerySet.as_manager()
+
+    @staticmethod
+    def get_digest(nvr_list):
+        return hashlib.sha256('\n'.join(sorted(set(nvr_list))).encode('utf-8')).hexdigest()
+
+    def nvrs(self):
+        return PackageSet.objects.nvrs_for([self.id])[self.id]
+
+
+
+class PackageSetMember(models.Model):
+    package_set = models.ForeignKey(PackageSet, related_name='members')
+    rpm         = models.ForeignKey(Rpm)
+    removed     = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (('package_set', 'rpm'),)
+
+
+
 class Registry(models.Model):
     url = models.URLField()
 
@@ -140,23 +455,28 @@ class ImageQuerySet(models.QuerySet):
     def children_as_list(self, image_id):
         return self.filter(parent=image_id).values_list('hash', flat=True)
 
+    def descendants_as_list(self, image_id):
+        """
+        return hashes of image_id and all of its descendants
+        """
+        return [image_id] + ImageLineage.objects.descendants_as_list(image_id)
+
     def invalidate(self, image_id):
         """
-        TODO:
-        make this more efficient
+        invalidate image and all of its descendants
 
-        :param image_id:
-        :return:
+        :param image_id: hash of the root image
+        :return: number of images which were newly invalidated
         """
         count = 0
-        to_invalidate = [image_id]
-        while True:
-            try:
-                parent_image = to_invalidate.pop()
-            except IndexError:
-                break
-            count += self.filter(hash=parent_image, image__is_invalidated=False).update(is_invalidated=True)
-            to_invalidate.extend(self.children_as_list(parent_image))
+        with transaction.atomic():
+            to_invalidate = self.descendants_as_list(image_id)
+            for chunk in chunks(to_invalidate, CHUNK_SIZE):
+                count += self.filter(
+                    hash__in=chunk,
+                    is_invalidated=False,
+                ).update(is_invalidated=True)
+        image_cache.evict(to_invalidate)
         return count
 
 
@@ -176,10 +496,15 @@ class Image(models.Model):
     hash        = models.CharField(max_length=64, primary_key=True)
     parent      = models.ForeignKey('self', null=True, blank=True)  # base images doesnt have parents
     task        = models.OneToOneField(Task, null=True, blank=True)
-    status      = models.IntegerField(choices=_STATUS_NAMES.items(), default=STATUS_BUILD)
+    status      = models.IntegerField(choices=_STATUS_NAMES.items(), default=STATUS_BUILD, db_index=True)
     content     = models.ManyToManyField(Content)
+    package_set = models.ForeignKey(PackageSet, null=True, blank=True)
     dockerfile  = models.ForeignKey('Dockerfile', null=True, blank=True)
-    is_invalidated = models.BooleanField(default=False)
+    is_invalidated = models.BooleanField(default=False, db_index=True)
+    # increased in the database by image_cache.evict whenever responses
+    # describing the image change; save loaded images with update_fields,
+    # so that an old value is not written back
+    version     = models.PositiveIntegerField(default=0)
 
     objects = ImageQuerySet.as_manager()
 
@@ -191,44 +516,111 @@ class Image(models.Model):
 
     @classmethod
     def create(cls, image_id, status, tags=None, task=None, parent=None, dockerfile=None):
-        image, _ = cls.objects.get_or_create(hash=image_id, status=status)
+        image, created = cls.objects.get_or_create(hash=image_id, status=status)
+        old_parent_id = image.parent_id
         image.task = task
         image.parent = parent
         if dockerfile:
             image.dockerfile = dockerfile
-        image.save()
+        image.save(update_fields=['task', 'parent', 'dockerfile'])
+        affected = [image.hash]
+        if created or image.parent_id != old_parent_id:
+            # responses describing the old and the new lineage are stale too
+            affected.extend(image.ancestors)
+            ImageLineage.objects.attach(image.hash, image.parent_id)
+            affected.extend(image.ancestors)
         for tag in tags:
             t, _ = Tag.objects.get_or_create(name=tag)
             t.save()
             rel = ImageRegistryRelation(tag=t, image=image)
             rel.save()
+        image_cache.evict(affected)
         return image
 
     @property
     def tags(self):
+        if hasattr(self, '_prefetched_tags'):
+            return list(self._prefetched_tags)
         return Tag.objects.for_image_as_list(self)
 
     @property
     def children(self):
         return Image.objects.filter(parent=self)
 
+    @property
+    def ancestors(self):
+        return ImageLineage.objects.ancestors_as_list(self.hash)
+
+    @property
+    def depth(self):
+        return ImageLineage.objects.depth_of(self.hash)
+
     def ordered_rpms_list(self):
+        if hasattr(self, '_prefetched_rpms'):
+            return list(self._prefetched_rpms)
+        if self.package_set_id:
+            return self.package_set.nvrs()
+        # images stored before package sets were introduced
         return list(Rpm.objects.filter(part_of__image=self).values_list('nvr', flat=True).order_by('nvr'))
 
     @property
     def rpms_count(self):
+        if hasattr(self, '_prefetched_rpms'):
+            return len(self._prefetched_rpms)
+        if self.package_set_id:
+            return self.package_set.size
         return Rpm.objects.filter(part_of__image=self).count()
 
-    def add_rpms_list(self, nvr_list):
+    @classmethod
+    def prefetch_related_data(cls, images):
+        """
+        load rpms and tags of all provided images at once, so that
+        ordered_rpms_list, rpms_count, tags and __json__ of these images
+        do not hit the database (tasks should be loaded by select_related)
+
+        :param images: list of images
+        :return: the same list
+        """
+        rpms = dict((image.hash, []) for image in images)
+        tags = dict((image.hash, []) for image in images)
+        package_sets = PackageSet.objects.nvrs_for(
+            image.package_set_id for image in images if image.package_set_id)
+        for image in images:
+            if image.package_set_id:
+                rpms[image.hash] = package_sets[image.package_set_id]
+        legacy = [image.hash for image in images if not image.package_set_id]
+        for chunk in chunks(legacy, CHUNK_SIZE):
+            for image_id, nvr in Rpm.objects.filter(part_of__image__in=chunk) \
+                    .values_list('part_of__image', 'nvr').order_by('nvr'):
+                rpms[image_id].append(nvr)
+        for chunk in chunks(tags, CHUNK_SIZE):
+            for image_id, name in ImageRegistryRelation.objects.filter(image__in=chunk) \
+                    .values_list('image', 'tag__name').order_by('id'):
+                tags[image_id].append(name)
+        for image in images:
+            image._prefetched_rpms = rpms[image.hash]
+            image._prefetched_tags = tags[image.hash]
+        return images
+
+    def add_rpms_list(self, nvr_list, base=None):
         """
         provide a list of RPM nvrs and link them to image
+
+        the image is switched to a package set containing both its current
+        rpms and the provided ones; packages and rpms are resolved and
+        created in bulk, so the number of queries does not depend on
+        length of the list
+
+        :param nvr_list: list of RPM nvrs
+        :param base: PackageSet to store the new set against,
+                     defaults to current package set of the image
         """
-        for nvr in nvr_list:
-            rpm = Rpm.objects.get_or_create_from_nvr(nvr)
-            if rpm:
-                rpm_ct = ContentType.objects.get(model='rpm')
-                content, _ = Content.objects.get_or_create(object_id=rpm.id, content_type=rpm_ct)
-                self.content.add(content)
+        with transaction.atomic():
+            nvrs = set(nvr_list).union(self.ordered_rpms_list())
+            self.package_set = PackageSet.objects.get_or_create_from_nvrs(
+                nvrs, base=base or self.package_set)
+            self.save(update_fields=['package_set'])
+        image_cache.evict([self.hash])
 
     def __json__(self):
         response = {
@@ -238,14 +630,110 @@ class Image(models.Model):
             'rpms':             self.ordered_rpms_list(),
             'tags':             self.tags,
             # 'registries': copy.copy(registries),
-            'parent':           getattr(self.parent, 'hash', None)
+            'parent':           self.parent_id,
         }
-        if self.task:
+        if self.task_id:
             response['built_on'] = str(self.task.date_finished)
         return response
 
 
 
+class ImageLineageQuerySet(models.QuerySet):
+    def ancestors_as_list(self, image_id):
+        """
+        return hashes of all ancestors of image_id, nearest first
+        """
+        return list(self.filter(descendant=image_id, depth__gt=0)
+                    .order_by('depth').values_list('ancestor', flat=True))
+
+    def descendants_as_list(self, image_id):
+        """
+        return hashes of all descendants of image_id, ordered by generation
+        """
+        return list(self.filter(ancestor=image_id, depth__gt=0)
+                    .order_by('depth').values_list('descendant', flat=True))
+
+    def depth_of(self, image_id):
+        """
+        return number of ancestors of image_id (base images have depth 0)
+        """
+        return self.filter(descendant=image_id).aggregate(
+            depth=models.Max('depth'))['depth'] or 0
+
+    def attach(self, image_id, parent_id):
+        """
+        (re)link image_id together with its whole subtree under parent_id;
+        parent_id may be None for base images
+        """
+        with transaction.atomic():
+            subtree = list(self.filter(ancestor=image_id).values_list('descendant', 'depth'))
+            if not subtree:
+                self.create(ancestor_id=image_id, descendant_id=image_id, depth=0)
+                subtree = [(image_id, 0)]
+            subtree_ids = [descendant for descendant, _ in subtree]
+            if parent_id in subtree_ids:
+                logger.error('Refusing to make "%s" a parent of its own descendant "%s"',
+                             parent_id, image_id)
+                return
+            # detach subtree from its previous ancestors
+            subtree_query = self.filter(ancestor=image_id).values('descendant')
+            stale = list(self.filter(descendant__in=subtree_query)
+                         .exclude(ancestor__in=subtree_query).values_list('id', flat=True))
+            for chunk in chunks(stale, CHUNK_SIZE):
+                self.filter(id__in=chunk).delete()
+            if parent_id is None:
+                return
+            ancestors = list(self.filter(descendant=parent_id).values_list('ancestor', 'depth'))
+            if not ancestors:
+                self.create(ancestor_id=parent_id, descendant_id=parent_id, depth=0)
+                ancestors = [(parent_id, 0)]
+            self.bulk_create([
+                ImageLineage(ancestor_id=ancestor, descendant_id=descendant,
+                             depth=ancestor_depth + descendant_depth + 1)
+                for ancestor, ancestor_depth in ancestors
+                for descendant, descendant_depth in subtree
+            ], batch_size=CHUNK_SIZE)
+
+    def rebuild(self):
+        """
+        drop the whole index and build it again from Image.parent links
+
+        :return: number of stored records
+        """
+        parents = dict(Image.objects.values_list('hash', 'parent'))
+        records = []
+        for image_id in parents:
+            depth = 0
+            ancestor = image_id
+            seen = set()
+            while ancestor is not None and ancestor not in seen:
+                records.append(ImageLineage(ancestor_id=ancestor, descendant_id=image_id, depth=depth))
+                seen.add(ancestor)
+                ancestor = parents.get(ancestor)
+                depth += 1
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(records, batch_size=CHUNK_SIZE)
+        return len(records)
+
+
+
+class ImageLineage(models.Model):
+    """
+    closure table of Image.parent links, every image is also linked
+    to itself with depth 0
+    """
+    ancestor    = models.ForeignKey(Image, related_name='descendant_links')
+    descendant  = models.ForeignKey(Image, related_name='ancestor_links')
+    depth       = models.PositiveIntegerField()
+
+    objects = ImageLineageQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (('ancestor', 'descendant'),)
+
+
+
 class TagQuerySet(models.QuerySet):
     def for_image(self, image):
         return self.filter(registry_bindings__image=image)
@@ -253,11 +741,21 @@ class TagQuerySet(models.QuerySet):
     def for_image_as_list(self, image):
         return list(self.for_image(image).values_list('name', flat=True))
 
+    def for_images_as_dict(self, image_ids):
+        """
+        return dict {image id: list of names of its tags}
+        """
+        tags = dict((image_id, []) for image_id in image_ids)
+        for image_id, name in self.filter(registry_bindings__image__in=image_ids) \
+                .values_list('registry_bindings__image', 'name').order_by('registry_bindings__id'):
+            tags[image_id].append(name)
+        return tags
+
 
 
 # TODO: do relations with this
 class Tag(models.Model):
-    name = models.CharField(max_length=64)
+    name = models.CharField(max_length=64, unique=True)
 
     objects = TagQuerySet.as_manager()
 
@@ -275,3 +773,102 @@ class Dockerfile(models.Model):
 
 
 
+class RebuildRun(models.Model):
+    """
+    rebuild of an image together with all its descendants
+    """
+    STATUS_RUNNING  = 1
+    STATUS_FAILED   = 2
+    STATUS_SUCCESS  = 3
+    _STATUS_NAMES   = {
+        STATUS_RUNNING: 'Running',
+        STATUS_FAILED:  'Failed',
+        STATUS_SUCCESS: 'Successful',
+    }
+
+    root            = models.ForeignKey(Image, related_name='rebuild_runs')
+    owner           = models.CharField(max_length=38)
+    concurrency     = models.PositiveIntegerField()
+    status          = models.IntegerField(choices=_STATUS_NAMES.items(), default=STATUS_RUNNING)
+    date_started    = models.DateTimeField(auto_now_add=True)
+    date_finished   = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "%d [%s]" % (self.id, self.get_status_display())
+
+    def duration(self):
+        """
+        return wall-clock time of the rebuild in seconds (so far)
+        """
+        return ((self.date_finished or timezone.now()) - self.date_started).total_seconds()
+
+    def progress(self):
+        """
+        return dict {status name: number of steps}
+        """
+        counts = dict(self.steps.values_list('status').annotate(count=models.Count('id')))
+        return dict((name, counts.get(status, 0)) for status, name in RebuildStep._STATUS_NAMES.items())
+
+    def __json__(self):
+        steps = self.steps.select_related('parent', 'task').order_by('depth', 'id')
+        return {
+            "run_id": self.id,
+            "root": self.root_id,
+            "status": self.get_status_display(),
+            "owner": self.owner,
+            "concurrency": self.concurrency,
+            "started": str(self.date_started),
+            "finished": str(self.date_finished),
+            "duration": self.duration(),
+            "progress": self.progress(),
+            "plan": [step.__json__() for step in steps],
+        }
+
+
+
+class RebuildStep(models.Model):
+    """
+    rebuild of a single image within RebuildRun; a step starts
+    when the step of the parent image succeeds
+    """
+    STATUS_WAITING  = 1
+    STATUS_RUNNING  = 2
+    STATUS_FAILED   = 3
+    STATUS_SUCCESS  = 4
+    STATUS_SKIPPED  = 5
+    STATUS_CANCELLED = 6
+    _STATUS_NAMES   = {
+        STATUS_WAITING:   'Waiting',
+        STATUS_RUNNING:   'Running',
+        STATUS_FAILED:    'Failed',
+        STATUS_SUCCESS:   'Successful',
+        STATUS_SKIPPED:   'Skipped',
+        STATUS_CANCELLED: 'Cancelled',
+    }
+
+    run             = models.ForeignKey(RebuildRun, related_name='steps')
+    image           = models.ForeignKey(Image, related_name='rebuild_steps')
+    parent          = models.ForeignKey('self', null=True, blank=True, related_name='children')
+    depth           = models.PositiveIntegerField()
+    status          = models.IntegerField(choices=_STATUS_NAMES.items(), default=STATUS_WAITING)
+    task            = models.OneToOneField(Task, null=True, blank=True)
+    new_image       = models.ForeignKey(Image, null=True, blank=True, related_name='+')
+    date_started    = models.DateTimeField(null=True, blank=True)
+    date_finished   = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = (
+            ('run', 'status'),
+        )
+
+    def __json__(self):
+        return {
+            "image_id": self.image_id,
+            "parent_image_id": self.parent.image_id if self.parent else None,
+            "depth": self.depth,
+            "status": self.get_status_display(),
+            "task_id": self.task_id,
+            "new_image_id": self.new_image_id,
+            "started": str(self.date_started),
+            "finished": str(self.date_finished),
+        }
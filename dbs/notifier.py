@@ -0,0 +1,137 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils.six.moves import queue
+
+__all__ = ('LocalNotifier', 'RedisNotifier', 'get_notifier')
+
+
+logger = logging.getLogger(__name__)
+
+
+class LocalNotifier(object):
+    """
+    publish changes of task states to subscribers within this process
+
+    Subscribers do not learn about tasks finished by other processes,
+    they should check state of the task every poll_interval seconds.
+    """
+
+    class Subscription(object):
+        def __init__(self, notifier, task_id):
+            self.notifier = notifier
+            self.task_id = task_id
+            self.queue = queue.Queue()
+
+        def get(self, timeout=None):
+            """
+            wait for next state of the task
+
+            :return: dict with task_id and status or None on timeout
+            """
+            try:
+                return self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        def close(self):
+            self.notifier._unsubscribe(self)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    @property
+    def poll_interval(self):
+        return settings.DBS_LOCAL_NOTIFIER_POLL_INTERVAL
+
+    def subscribe(self, task_id):
+        subscription = self.Subscription(self, int(task_id))
+        with self._lock:
+            self._subscriptions.setdefault(subscription.task_id, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.task_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.task_id, None)
+
+    def notify(self, task_id, status):
+        message = {'task_id': int(task_id), 'status': status}
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(int(task_id), ()))
+        for subscription in subscriptions:
+            subscription.queue.put(message)
+
+
+class RedisNotifier(object):
+    """
+    publish changes of task states to subscribers in all processes using redis pub/sub
+    """
+    # subscribers need not check state of tasks themselves
+    poll_interval = None
+
+    class Subscription(object):
+        def __init__(self, client, task_id):
+            self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(RedisNotifier.channel(task_id))
+
+        def get(self, timeout=None):
+            """
+            wait for next state of the task
+
+            :return: dict with task_id and status or None on timeout
+            """
+            deadline = timeout is not None and time.time() + timeout
+            while True:
+                remaining = deadline and max(deadline - time.time(), 0)
+                message = self.pubsub.get_message(timeout=remaining if deadline else 1.0)
+                if message and message['type'] == 'message':
+                    return json.loads(message['data'].decode('utf-8'))
+                if deadline and time.time() >= deadline:
+                    return None
+
+        def close(self):
+            self.pubsub.close()
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+
+    @staticmethod
+    def channel(task_id):
+        return 'dbs:task:%d' % int(task_id)
+
+    def subscribe(self, task_id):
+        return self.Subscription(self.client, task_id)
+
+    def notify(self, task_id, status):
+        try:
+            self.client.publish(self.channel(task_id), json.dumps({'task_id': int(task_id), 'status': status}))
+        except Exception:
+            logger.exception('Failed to publish state of task %s', task_id)
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_notifier():
+    """
+    return notifier configured by settings (DBS_NOTIFIER_URL)
+    """
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            if settings.DBS_NOTIFIER_URL:
+                _notifier = RedisNotifier(settings.DBS_NOTIFIER_URL)
+            else:
+                _notifier = LocalNotifier()
+        return _notifier
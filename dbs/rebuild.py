@@ -0,0 +1,137 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import json
+import logging
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .api.core import build_fingerprint, new_build_kwargs, new_build_task, new_image_callback
+from .api.forms import NewImageForm
+from .models import Image, ImageLineage, RebuildRun, RebuildStep, Task, TaskData
+from .task_api import TaskApi
+
+
+logger = logging.getLogger(__name__)
+
+builder_api = TaskApi()
+
+
+def start_rebuild(root_id, owner, concurrency=None):
+    """
+    plan rebuild of image root_id and all its descendants and start
+    the first builds
+
+    Images are rebuilt from the task data of their original build; every
+    child waits until its parent is rebuilt, siblings are built in parallel,
+    at most concurrency builds at a time. Images which were not built by dbs
+    (e.g. base images) are skipped.
+
+    :return: RebuildRun
+    """
+    root = Image.objects.get(hash=root_id)
+    run = RebuildRun(root=root, owner=owner, concurrency=concurrency or settings.DBS_REBUILD_CONCURRENCY)
+    run.save()
+    # the root is linked to itself with depth 0, so the lineage query
+    # returns the whole subtree ordered by generation
+    subtree = ImageLineage.objects.filter(ancestor=root_id).order_by('depth') \
+        .values_list('descendant', 'depth', 'descendant__parent', 'descendant__task')
+    generations = []
+    for image_id, depth, parent_id, task_id in subtree:
+        if not generations or generations[-1][0] != depth:
+            generations.append((depth, []))
+        generations[-1][1].append((image_id, parent_id, task_id))
+    step_ids = {}
+    for depth, images in generations:
+        RebuildStep.objects.bulk_create([
+            RebuildStep(run=run, image_id=image_id, parent_id=step_ids.get(parent_id), depth=depth,
+                        status=RebuildStep.STATUS_WAITING if task_id else RebuildStep.STATUS_SKIPPED)
+            for image_id, parent_id, task_id in images
+        ])
+        # bulk_create does not set primary keys on all backends
+        step_ids.update(run.steps.filter(depth=depth).values_list('image', 'id'))
+    logger.info('rebuild %d of "%s": %d images planned', run.id, root_id, len(step_ids))
+    advance_rebuild(run.id)
+    # advance_rebuild may have finished the run already
+    return RebuildRun.objects.get(id=run.id)
+
+
+def advance_rebuild(run_id):
+    """
+    start builds of all steps whose parents are rebuilt, as long as
+    the concurrency of the run allows; finish the run when nothing is left
+    """
+    run = RebuildRun.objects.get(id=run_id)
+    if run.status != RebuildRun.STATUS_RUNNING:
+        return
+    # descendants of failed images would be built on the old parent
+    while run.steps.filter(
+        status=RebuildStep.STATUS_WAITING,
+        parent__status__in=(RebuildStep.STATUS_FAILED, RebuildStep.STATUS_CANCELLED),
+    ).update(status=RebuildStep.STATUS_CANCELLED, date_finished=timezone.now()):
+        pass
+    running = run.steps.filter(status=RebuildStep.STATUS_RUNNING).count()
+    ready = list(run.steps.filter(status=RebuildStep.STATUS_WAITING).filter(
+        Q(parent=None) | Q(parent__status__in=(RebuildStep.STATUS_SUCCESS, RebuildStep.STATUS_SKIPPED))
+    ).select_related('image__task__task_data').order_by('depth', 'id')[:max(run.concurrency - running, 0)])
+    if not ready and not running:
+        failed = run.steps.filter(
+            status__in=(RebuildStep.STATUS_FAILED, RebuildStep.STATUS_CANCELLED)).exists()
+        status = RebuildRun.STATUS_FAILED if failed else RebuildRun.STATUS_SUCCESS
+        # callbacks of the last steps may get here at once, one finishes the run
+        if RebuildRun.objects.filter(id=run_id, status=RebuildRun.STATUS_RUNNING).update(
+                status=status, date_finished=timezone.now()):
+            run = RebuildRun.objects.get(id=run_id)
+            logger.info('rebuild %d finished: %s in %.1fs', run.id, run.get_status_display(), run.duration())
+        return
+    builds = []
+    for step in ready:
+        # select_for_update does not lock on every database (SQLite);
+        # concurrent callbacks may find the same ready steps, every step
+        # is started by the one which moves it from waiting to running
+        with transaction.atomic():
+            if not RebuildStep.objects.filter(id=step.id, status=RebuildStep.STATUS_WAITING).update(
+                    status=RebuildStep.STATUS_RUNNING, date_started=timezone.now()):
+                continue
+            form = NewImageForm(data=json.loads(step.image.task.task_data.json))
+            if not form.is_valid():
+                logger.error('rebuild %d: can not rebuild "%s": %s', run.id, step.image_id, form.errors)
+                RebuildStep.objects.filter(id=step.id).update(
+                    status=RebuildStep.STATUS_FAILED, date_finished=timezone.now())
+                continue
+            # rebuilds always build, they are not deduplicated
+            form.cleaned_data.pop('force')
+            td = TaskData(json=json.dumps(form.cleaned_data))
+            td.save()
+            t = new_build_task(run.owner, td, build_fingerprint(form.cleaned_data))
+            t.save()
+            RebuildStep.objects.filter(id=step.id).update(task=t)
+        build_kwargs = new_build_kwargs(form.cleaned_data, run.owner, t)
+        build_kwargs['callback'] = partial(rebuild_step_callback, step.id, t.id)
+        builds.append(build_kwargs)
+    if builds:
+        builder_api.build_docker_images(builds)
+    elif ready:
+        # the ready steps failed before they were sent or were started
+        # by another callback, look for more work
+        advance_rebuild(run_id)
+
+
+def rebuild_step_callback(step_id, task_id, build_results):
+    """
+    store results of a build started by a rebuild and continue the rebuild
+    """
+    if not new_image_callback(task_id, build_results):
+        # another process stores the results and continues the rebuild
+        return
+    status = Task.objects.filter(id=task_id).values_list('status', flat=True)[0]
+    new_image_id = Image.objects.filter(task=task_id).values_list('hash', flat=True).first()
+    step = RebuildStep.objects.get(id=step_id)
+    step.status = RebuildStep.STATUS_SUCCESS if status == Task.STATUS_SUCCESS else RebuildStep.STATUS_FAILED
+    step.new_image_id = new_image_id
+    step.date_finished = timezone.now()
+    step.save()
+    advance_rebuild(step.run_id)
@@ -10,9 +10,13 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 
 from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
 
+import os
+
+from kombu import Queue
+
 # localsettings is used to store site depandant settings
 from .site_settings import (
-    SECRET_KEY, ALLOWED_HOSTS, DATABASES,
+    BASE_DIR, SECRET_KEY, ALLOWED_HOSTS, DATABASES,
     DEBUG, DBDEBUG, TEMPLATE_DEBUG,
     ADMINS, MANAGERS, SERVER_EMAIL,
     LANGUAGE_CODE, TIME_ZONE, LANGUAGES,
@@ -36,6 +40,8 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # first, so that it measures the whole request
+    'dbs.metrics.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -81,6 +87,18 @@ LOGGING = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.7/topics/cache/
+# cached API responses are keyed by versions of images stored in the
+# database, so processes with their own local memory cache never serve
+# stale responses; a shared backend (memcached, redis) shares the entries
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -90,6 +108,70 @@ USE_L10N = True
 
 USE_TZ = True
 
+# API configuration
+# default and maximal number of items returned in one page of a listing
+DBS_API_PAGE_SIZE = 50
+DBS_API_MAX_PAGE_SIZE = 500
+# maximal number of builds submitted in one batch
+DBS_API_MAX_BATCH_SIZE = 500
+
+# cache used for responses of image status, info and deps calls
+DBS_API_CACHE = 'default'
+# seconds to keep the responses cached
+DBS_API_CACHE_TIMEOUT = 300
+
+# Task state notifications used by long-poll and event stream calls;
+# None means in-process notifications, which reach only requests served
+# by the process running the callbacks, use redis URL for several processes
+DBS_NOTIFIER_URL = None
+# seconds between checks of task state in the database by waiting requests
+# when the notifications are in-process, so that they learn also about
+# tasks whose callbacks ran in other processes
+DBS_LOCAL_NOTIFIER_POLL_INTERVAL = 2.0
+# maximal number of seconds a long-poll request waits
+DBS_LONG_POLL_MAX_TIMEOUT = 60
+# maximal number of seconds an event stream stays open
+DBS_EVENT_STREAM_MAX_DURATION = 600
+
+# Task result dispatcher
+# number of threads executing callbacks of finished tasks
+DBS_DISPATCHER_WORKERS = 4
+# seconds between two checks of results of watched tasks
+DBS_DISPATCHER_POLL_INTERVAL = 1.0
+# maximal number of finished tasks waiting for a callback thread
+DBS_DISPATCHER_QUEUE_SIZE = 1000
+# seconds after which unfinished tasks are considered lost: they are
+# stored as failed when the service starts and builds are not reused from them
+DBS_TASK_TIMEOUT = 24 * 3600
+
+# default maximal number of builds running at once during a rebuild of image tree
+DBS_REBUILD_CONCURRENCY = 4
+
+# maximal number of pushes running at once in one push task (on workers)
+DBS_PUSH_WORKERS = 4
+
+# Worker image cache
+# images pulled by workers are tracked in this file, so they are pulled
+# again only when they change in the registry
+DBS_WORKER_IMAGE_CACHE_STATE = os.path.join(BASE_DIR, 'data', 'worker-image-cache.json')
+# bytes of disk space the tracked images may take, least recently used
+# images are removed when it is exceeded
+DBS_WORKER_IMAGE_CACHE_BUDGET = 20 * 1024 ** 3
+DBS_WORKER_DOCKER_URL = 'unix://var/run/docker.sock'
+
+# Build backend used by workers to build, pull and push images;
+# 'dbs.backends.simulated.SimulatedBackend' does not need docker
+# and is meant for load tests
+DBS_BUILD_BACKEND = 'dbs.backends.dock.DockBackend'
+# the simulated operations take seconds from the ranges and fail with
+# failure_rate, see dbs/backends/simulated.py for the other keys
+DBS_SIMULATED_BACKEND = {
+    'build_duration': (5.0, 30.0),
+    'pull_duration': (0.1, 2.0),
+    'push_duration': (0.5, 5.0),
+    'failure_rate': 0.0,
+}
+
 # Celery configuration
 BROKER_TRANSPORT_OPTIONS = {
     'fanout_prefix': True,
@@ -100,3 +182,41 @@ CELERY_TASK_SERIALIZER = 'pickle'
 CELERY_RESULT_SERIALIZER = 'pickle'
 CELERY_ACCEPT_CONTENT = ['json', 'pickle']
 CELERY_ENABLE_UTC = True
+
+# every kind of tasks has its own queue, so that long builds do not block
+# pushes and bookkeeping tasks; workers started without -Q consume all of them
+CELERY_QUEUES = (
+    Queue('dbs.build', routing_key='dbs.build'),
+    Queue('dbs.push', routing_key='dbs.push'),
+    Queue('dbs.bookkeeping', routing_key='dbs.bookkeeping'),
+)
+CELERY_DEFAULT_QUEUE = 'dbs.bookkeeping'
+CELERY_DEFAULT_ROUTING_KEY = 'dbs.bookkeeping'
+CELERY_ROUTES = {
+    'dbs.tasks.build_image':            {'queue': 'dbs.build', 'routing_key': 'dbs.build'},
+    'dbs.tasks.build_image_hostdocker': {'queue': 'dbs.build', 'routing_key': 'dbs.build'},
+    'dbs.tasks.push_image':             {'queue': 'dbs.push', 'routing_key': 'dbs.push'},
+    'dbs.tasks.submit_results':         {'queue': 'dbs.bookkeeping', 'routing_key': 'dbs.bookkeeping'},
+}
+
+# Worker profiles, see `dbs worker <profile>`
+# prefetch_multiplier 1 makes the worker reserve only tasks it can start
+# right away, queued builds then wait for any free worker instead of
+# a busy one
+DBS_WORKER_PROFILES = {
+    'build': {
+        'queues': ('dbs.build',),
+        'concurrency': 2,
+        'prefetch_multiplier': 1,
+    },
+    'push': {
+        'queues': ('dbs.push',),
+        'concurrency': 4,
+        'prefetch_multiplier': 1,
+    },
+    'bookkeeping': {
+        'queues': ('dbs.bookkeeping',),
+        'concurrency': 2,
+        'prefetch_multiplier': 4,
+    },
+}
@@ -1,39 +1,18 @@
-from threading import Thread
-from celery import Celery
+from celery import Celery, group
 
 from . import tasks
 from .celery import app
+from .dispatcher import get_dispatcher
 
 __all__ = ('TaskApi', )
 
 
-def watch_task(task, callback, kwargs=None):
-    """
-    watch task until it ends and then execute callback:
-
-        callback(response, **kwargs)
-
-    where response is a result of task
-
-    :param task: task to watch
-    :param callback: function which is called when task finishes
-    :param kwargs: dict which is passed to callback
-
-    :return: None
-    """
-    response = task.wait()
-    if kwargs:
-        callback(response, **kwargs)
-    else:
-        callback(response)
-
-
 class TaskApi(object):
     """ universal API for tasks which are executed on celery workers """
 
     def build_docker_image(self, build_image, git_url, local_tag, git_dockerfile_path=None, git_commit=None,
                            parent_registry=None, target_registries=None, tag=None, repos=None,
-                           callback=None, kwargs=None):
+                           callback=None, kwargs=None, task_id=None):
         """
         build docker image from supplied git repo
 
@@ -51,11 +30,42 @@ class TaskApi(object):
         :param tag: tag image with this tag (and push it to target_repo if specified)
         :param repos: list of yum repos to enable in image
         :param callback: function to call when task finishes, it has to accept at least
-                        one argument: return value of task
+                        one argument: return value of task (None if the task failed)
         :param kwargs: dict which is pass to callback, callback is called like this:
                          callback(task_response, **kwargs)
+        :param task_id: id for the celery task, generated if not provided
         :return: task_id
         """
+        signature = self._build_signature(build_image, git_url, local_tag, git_dockerfile_path, git_commit,
+                                          parent_registry, target_registries, tag, repos, task_id)
+        task_info = signature.apply_async()
+        task_id = task_info.task_id
+        if callback:
+            get_dispatcher().watch(task_info, callback, kwargs)
+        return task_id
+
+    def build_docker_images(self, builds):
+        """
+        build several docker images at once; builds are sent to workers
+        as a single celery group
+
+        :param builds: list of dicts with arguments of build_docker_image
+        :return: list of task_ids
+        """
+        signatures = []
+        for build in builds:
+            build = dict(build)
+            build.pop('callback', None)
+            build.pop('kwargs', None)
+            signatures.append(self._build_signature(**build))
+        group_info = group(signatures).apply_async()
+        for build, task_info in zip(builds, group_info.results):
+            if build.get('callback'):
+                get_dispatcher().watch(task_info, build['callback'], build.get('kwargs'))
+        return [task_info.task_id for task_info in group_info.results]
+
+    def _build_signature(self, build_image, git_url, local_tag, git_dockerfile_path=None, git_commit=None,
+                         parent_registry=None, target_registries=None, tag=None, repos=None, task_id=None):
         args = (build_image, git_url, local_tag)
         task_kwargs = {'parent_registry': parent_registry,
                        'target_registries': target_registries,
@@ -63,38 +73,35 @@ class TaskApi(object):
                        'git_commit': git_commit,
                        'git_dockerfile_path': git_dockerfile_path,
                        'repos': repos}
-        task_info = tasks.build_image.apply_async(args=args, kwargs=task_kwargs,
-                                                   link=tasks.submit_results.s())
-        task_id = task_info.task_id
-        if callback:
-            t = Thread(target=watch_task, args=(task_info, callback, kwargs))
-            #w.daemon = True
-            t.start()
-        return task_id
+        options = {'link': tasks.submit_results.s()}
+        if task_id:
+            options['task_id'] = task_id
+        return tasks.build_image.signature(args=args, kwargs=task_kwargs, **options)
 
     def find_dockerfiles_in_git(self):
         raise NotImplemented()
 
-    def push_docker_image(self, image_id, source_registry, target_registry, tags, callback=None, kwargs=None):
+    def push_docker_image(self, image_id, source_registry, target_registries, tags, callback=None, kwargs=None,
+                          task_id=None):
         """
-        pull docker image from source registry, tag it with multiple tags and push it to target registry
+        pull docker image from source registry, tag it with multiple tags and push it to target registries
 
         :param image_id: image to pull
         :param source_registry: registry to pull from
-        :param target_registry: registry for pushing
+        :param target_registries: list of registries for pushing
         :param tags: list of tags for image tagging
         :param callback: function to call when task finishes, it has to accept at least
-                        one argument: return value of task
+                        one argument: return value of task (None if the task failed)
         :param kwargs: dict which is pass to callback, callback is called like this:
                          callback(task_response, **kwargs)
+        :param task_id: id for the celery task, generated if not provided
         :return: task_id
         """
-        task_info = tasks.push_image.delay(image_id, source_registry, target_registry, tags)
+        task_info = tasks.push_image.apply_async(args=(image_id, source_registry, target_registries, tags),
+                                                 task_id=task_id)
         task_id = task_info.task_id
         if callback:
-            t = Thread(target=watch_task, args=(task_info, callback, kwargs))
-            #w.daemon = True
-            t.start()
+            get_dispatcher().watch(task_info, callback, kwargs)
         return task_id
 
 
@@ -121,4 +128,5 @@ if __name__ == '__main__':
                          git_url="github.com/TomasTomecek/docker-hello-world.git",
                          local_tag="fedora-celery-build",
                          callback=desktop_callback)
+    get_dispatcher().wait()
 
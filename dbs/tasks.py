@@ -1,15 +1,33 @@
 from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
 
 import logging
+import time
+from multiprocessing.pool import ThreadPool
 
 from celery import shared_task
-from dock.core import DockerTasker
-from dock.api import build_image_in_privileged_container, build_image_using_hosts_docker
+from django.conf import settings
+from django.utils.six import string_types
+
+from .backends import get_build_backend
 
 
 logger = logging.getLogger(__name__)
 
 
+def _prepare_build_image(backend, build_image):
+    """
+    make sure build image is present on the worker
+
+    :return: dict describing use of worker image cache
+    """
+    try:
+        return backend.prepare_image(build_image)
+    except Exception as ex:
+        # let the build fail with its own error if the image is really missing
+        logger.warning("failed to prepare build image %s: %r", build_image, ex)
+        return {"image": build_image, "hit": False, "error": repr(ex)}
+
+
 @shared_task
 def build_image_hostdocker(
         build_image, git_url, local_tag, git_dockerfile_path=None,
@@ -33,12 +51,16 @@ def build_image_hostdocker(
     :return: dict with data from docker inspect
     """
     logger.info("build image using hostdocker method")
+    backend = get_build_backend()
+    started = time.time()
+    image_cache = _prepare_build_image(backend, build_image)
+    prepared = time.time()
     target_registries = target_registries or []
     push_buildroot_to = None
     if store_results:
         target_registries.append('172.17.42.1:5000')
         push_buildroot_to = "172.17.42.1:5000"
-    results = build_image_using_hosts_docker(
+    results = backend.build_using_hosts_docker(
         build_image,
         git_url=git_url,
         image=local_tag,
@@ -49,6 +71,9 @@ def build_image_hostdocker(
         repos=repos,
         push_buildroot_to=push_buildroot_to,
     )
+    results.image_cache = [image_cache]
+    # git clone, pull of the parent, build and push run inside dock
+    results.timings = {'prepare': prepared - started, 'build': time.time() - prepared}
     return results
 
 @shared_task
@@ -72,12 +97,16 @@ def build_image(build_image, git_url, local_tag, git_dockerfile_path=None,
     :return: dict with data from docker inspect
     """
     logger.info("build image in privileged container")
+    backend = get_build_backend()
+    started = time.time()
+    image_cache = _prepare_build_image(backend, build_image)
+    prepared = time.time()
     target_registries = target_registries or []
     push_buildroot_to = None
     if store_results:
         target_registries.append('172.17.42.1:5000')
         push_buildroot_to = "172.17.42.1:5000"
-    results = build_image_in_privileged_container(
+    results = backend.build_in_privileged_container(
         build_image,
         git_url=git_url,
         image=local_tag,
@@ -88,31 +117,89 @@ def build_image(build_image, git_url, local_tag, git_dockerfile_path=None,
         repos=repos,
         push_buildroot_to=push_buildroot_to,
     )
+    results.image_cache = [image_cache]
+    # git clone, pull of the parent, build and push run inside dock
+    results.timings = {'prepare': prepared - started, 'build': time.time() - prepared}
     return results
 
 
+def _push(backend, image, tag, registry):
+    """
+    tag image and push it to registry using build backend
+
+    :return: dict with registry, tag, error (None on success) and duration in seconds
+    """
+    started = time.time()
+    try:
+        backend.tag_and_push(image, tag, registry)
+    except Exception as ex:
+        logger.error("push of %s to %s failed: %r", tag, registry, ex)
+        error = repr(ex)
+    else:
+        error = None
+    return {"registry": registry, "tag": tag, "error": error, "duration": time.time() - started}
+
+
 @shared_task
-def push_image(image_id, source_registry, target_registry, tags):
+def push_image(image_id, source_registry, target_registries, tags):
     """
-    pull image from source_registry and push it to target_registry (with provided tags)
+    pull image from source_registry (unless it is in worker image cache)
+    and push it to all target_registries with all provided tags
+
+    Pushes run concurrently in at most DBS_PUSH_WORKERS threads. The first tag
+    is pushed to each registry before the others, so the other pushes of the
+    same registry find the layers there and upload only the manifest.
 
     :param image_id: image to pull
     :param source_registry: registry to pull image from
-    :param target_registry: registry to push image to
-    :param tags: list of tags to tag image with before pushing it to target registry
-    :return: None
+    :param target_registries: list of registries to push image to
+    :param tags: list of tags to tag image with before pushing it to target registries
+    :return: dict with error (None if all pushes succeeded), list of pushes
+             (see _push), use of image cache, durations of pull and the whole task
+             and timings of phases
     """
     if not hasattr(tags, '__iter__'):
         raise RuntimeError("argument tags is not iterable")
-    d = DockerTasker()
+    if isinstance(target_registries, string_types):
+        target_registries = [target_registries]
+    tags = list(tags)
+    backend = get_build_backend()
+    started = time.time()
     try:
-        final_tag = d.pull_image(image_id, source_registry)
-        for tag in tags:
-            d.tag_and_push_image(final_tag, tag, reg_uri=target_registry)
+        image_cache = backend.prepare_image(image_id, source_registry)
     except Exception as ex:
-        return {"error": repr(ex.message)}
-    else:
-        return {"error": None}
+        return {"error": repr(ex), "pushes": [], "pull_duration": time.time() - started,
+                "duration": time.time() - started, "timings": {"pull": time.time() - started}}
+    final_tag = image_cache["image"]
+    pull_duration = time.time() - started
+    pushes = []
+    if tags and target_registries:
+        pool = ThreadPool(min(settings.DBS_PUSH_WORKERS, len(tags) * len(target_registries)))
+        try:
+            later = []
+
+            def first_pushed(push):
+                # runs in the result handler thread of the pool
+                pushes.append(push)
+                later.extend(pool.apply_async(_push, (backend, final_tag, tag, push["registry"])) for tag in tags[1:])
+
+            for first in [pool.apply_async(_push, (backend, final_tag, tags[0], registry),
+                                           callback=first_pushed)
+                          for registry in target_registries]:
+                first.get()
+            pushes.extend(push.get() for push in later)
+        finally:
+            pool.terminate()
+    failed = [push for push in pushes if push["error"]]
+    duration = time.time() - started
+    return {
+        "error": "%d of %d pushes failed" % (len(failed), len(pushes)) if failed else None,
+        "pushes": pushes,
+        "image_cache": [image_cache],
+        "pull_duration": pull_duration,
+        "duration": duration,
+        "timings": {"pull": pull_duration, "push": duration - pull_duration},
+    }
 
 
 @shared_task
@@ -121,5 +208,5 @@ def submit_results(result):
     TODO: implement this
     """
     # 2 requests, one for 'finished', other for data
-    print(result)
+    logger.debug("results: %r", result)
 
@@ -0,0 +1,207 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+
+from dbs.api import core, views
+from dbs.api.pagination import encode_cursor
+from dbs.models import Image, Task, TaskData
+from dbs.notifier import LocalNotifier
+
+
+def create_task(task_type=Task.TYPE_BUILD, status=Task.STATUS_PENDING, age=0, **kwargs):
+    """
+    create task started age seconds ago
+    """
+    task = Task.objects.create(builddev_id='buildroot-fedora', type=task_type, owner='test', status=status,
+                               task_data=TaskData.objects.create(json='{}'), **kwargs)
+    if age:
+        Task.objects.filter(id=task.id).update(date_started=timezone.now() - timedelta(seconds=age))
+    return task
+
+
+class ListImagesCallTest(TestCase):
+    def create_images(self, prefix, count):
+        base = Image.create(prefix + 'base', Image.STATUS_BASE, tags=['fedora:21'])
+        base.add_rpms_list(['bash-4.3.30-2.fc21', 'glibc-2.20-7.fc21'])
+        for i in range(count):
+            image = Image.create('%s%d' % (prefix, i), Image.STATUS_BUILD,
+                                 tags=['%s:%d' % (prefix, i)], parent=base)
+            image.add_rpms_list(['bash-4.3.30-2.fc21', 'httpd-2.4.10-%d.fc21' % i])
+
+    def get_images(self):
+        response = self.client.get('/v1/images')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))['results']
+
+    def test_query_count_does_not_grow(self):
+        self.create_images('few', 2)
+        # warm up content type cache
+        self.get_images()
+        with CaptureQueriesContext(connection) as few:
+            self.get_images()
+        self.create_images('many', 20)
+        with CaptureQueriesContext(connection) as many:
+            self.get_images()
+        self.assertEqual(len(few.captured_queries), len(many.captured_queries))
+
+    def test_serialized_image(self):
+        self.create_images('img', 1)
+        images = dict((image['hash'], image) for image in self.get_images())
+        self.assertEqual(images['img0']['parent'], 'imgbase')
+        self.assertEqual(images['img0']['tags'], ['img:0'])
+        self.assertEqual(images['img0']['rpms'], Image.objects.get(hash='img0').ordered_rpms_list())
+        self.assertEqual(images['imgbase']['parent'], None)
+
+
+class ImageInfoCallTest(TestCase):
+    def test_changes_made_by_other_process(self):
+        base = Image.create('base', Image.STATUS_BASE, tags=[])
+        Image.create('child', Image.STATUS_BUILD, tags=[], parent=base)
+        url = '/v1/image/child/info'
+        response = self.client.get(url)
+        self.assertFalse(json.loads(response.content.decode('utf-8'))['is_invalidated'])
+        # the other process evicts the image only from its own cache
+        with override_settings(CACHES={'other': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                                 'LOCATION': 'other'}}, DBS_API_CACHE='other'):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            Image.objects.invalidate('base')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        self.assertTrue(json.loads(self.client.get(url).content.decode('utf-8'))['is_invalidated'])
+
+
+class CursorTest(TestCase):
+    def get(self, url, values):
+        return self.client.get(url, {'cursor': encode_cursor(values)})
+
+    def test_invalid_cursors(self):
+        for url, values in (
+            ('/v1/images', {}),
+            ('/v1/images', {'hash': 1}),
+            ('/v1/tasks', {}),
+            ('/v1/tasks', {'id': None, 'date_finished': None}),
+            ('/v1/tasks', {'id': '1', 'date_finished': None}),
+            ('/v1/tasks', {'id': True, 'date_finished': None}),
+            ('/v1/tasks', {'id': 1, 'date_finished': 1}),
+            ('/v1/tasks', {'id': 1, 'date_finished': '2015-13-01T00:00:00'}),
+        ):
+            self.assertEqual(self.get(url, values).status_code, 400, (url, values))
+        self.assertEqual(self.client.get('/v1/tasks', {'cursor': 'not a cursor'}).status_code, 400)
+
+    def test_valid_cursors(self):
+        self.assertEqual(self.get('/v1/images', {'hash': 'a'}).status_code, 200)
+        self.assertEqual(self.get('/v1/tasks', {'id': 1, 'date_finished': None}).status_code, 200)
+        self.assertEqual(self.get('/v1/tasks', {'id': 1, 'date_finished': '2015-01-01T00:00:00+00:00'}).status_code,
+                         200)
+
+
+class WatchUnfinishedTasksTest(TestCase):
+    def test_results_are_stored_once(self):
+        task_id = create_task(status=Task.STATUS_RUNNING).id
+        self.assertTrue(core.new_image_callback(task_id, None))
+        self.assertEqual(Task.objects.get(id=task_id).status, Task.STATUS_FAILED)
+        self.assertFalse(core.new_image_callback(task_id, None))
+        move_id = create_task(Task.TYPE_MOVE, Task.STATUS_RUNNING).id
+        self.assertTrue(core.move_image_callback(move_id, {'error': None}))
+        self.assertFalse(core.move_image_callback(move_id, {'error': 'late'}))
+        self.assertEqual(Task.objects.get(id=move_id).status, Task.STATUS_SUCCESS)
+
+    def test_unfinished_tasks_are_watched(self):
+        watched = []
+
+        class Dispatcher(object):
+            def watch(self, result, callback, kwargs=None):
+                watched.append((result.task_id, callback.func))
+
+        build_id = create_task(status=Task.STATUS_RUNNING, celery_id='build').id
+        create_task(Task.TYPE_MOVE, Task.STATUS_RUNNING, celery_id='move')
+        lost_id = create_task(status=Task.STATUS_RUNNING, age=2 * settings.DBS_TASK_TIMEOUT, celery_id='lost').id
+        finished_id = create_task(status=Task.STATUS_RUNNING, celery_id='finished').id
+        core.new_image_callback(finished_id, None)
+        get_dispatcher = core.get_dispatcher
+        core.get_dispatcher = Dispatcher
+        try:
+            self.assertEqual(core.watch_unfinished_tasks(), 2)
+        finally:
+            core.get_dispatcher = get_dispatcher
+        self.assertEqual(watched, [('build', core.new_image_callback), ('move', core.move_image_callback)])
+        self.assertEqual(Task.objects.get(id=lost_id).status, Task.STATUS_FAILED)
+        self.assertEqual(Task.objects.get(id=build_id).status, Task.STATUS_RUNNING)
+
+
+class BuildReuseTest(TestCase):
+    build = {'git_url': 'https://example.com/app.git', 'git_commit': 'abc123', 'tag': 'app:1',
+             'target_registries': ['registry.example.com']}
+
+    def test_fingerprint_covers_push(self):
+        fingerprint = core.build_fingerprint(self.build)
+        self.assertEqual(fingerprint, core.build_fingerprint(dict(self.build, force=True)))
+        self.assertNotEqual(fingerprint, core.build_fingerprint(dict(self.build, tag='app:2')))
+        self.assertNotEqual(fingerprint, core.build_fingerprint(dict(self.build, target_registries=[])))
+        self.assertIsNone(core.build_fingerprint(dict(self.build, git_commit='')))
+
+    def test_lost_builds_are_not_reused(self):
+        create_task(status=Task.STATUS_RUNNING, fingerprint='running')
+        create_task(status=Task.STATUS_RUNNING, age=2 * settings.DBS_TASK_TIMEOUT, fingerprint='lost')
+        create_task(status=Task.STATUS_FAILED, fingerprint='failed')
+        self.assertEqual(sorted(Task.objects.reusable(['running', 'lost', 'failed'])), ['running'])
+
+
+class TaskStatusCallTest(TestCase):
+    def test_if_modified_since(self):
+        task = create_task()
+        url = '/v1/task/%d/status' % task.id
+        since = http_date(time.time() + 3600)
+        response = self.client.get(url)
+        self.assertNotIn('Last-Modified', response)
+        Task.objects.filter(id=task.id).update(status=Task.STATUS_RUNNING)
+        # status changed, but no date did
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['status'], 'Running')
+        core.new_image_callback(task.id, None)
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=since).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+
+
+class OtherProcessNotifier(LocalNotifier):
+    """
+    notifier of process which does not run callbacks: the task finishes
+    during the first wait, but no message arrives
+    """
+    class Subscription(LocalNotifier.Subscription):
+        def get(self, timeout=None):
+            Task.objects.filter(id=self.task_id).update(status=Task.STATUS_SUCCESS, date_finished=timezone.now())
+            return None
+
+
+class TaskWaitCallTest(TestCase):
+    def setUp(self):
+        self.task = create_task()
+        self.get_notifier = views.get_notifier
+        views.get_notifier = OtherProcessNotifier
+
+    def tearDown(self):
+        views.get_notifier = self.get_notifier
+
+    def test_wait_sees_task_finished_elsewhere(self):
+        response = json.loads(self.client.get('/v1/task/%d/wait?timeout=1' % self.task.id).content.decode('utf-8'))
+        self.assertEqual(response['status'], 'Successful')
+        self.assertFalse(response['timeout'])
+
+    def test_events_see_task_finished_elsewhere(self):
+        response = self.client.get('/v1/task/%d/events' % self.task.id)
+        events = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual([json.loads(line[len('data: '):])['status'] for line in events.splitlines()
+                          if line.startswith('data: ')], ['Pending', 'Successful'])
@@ -0,0 +1,144 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+from django.test import TestCase
+
+from dbs.benchmarks import legacy_add_rpms_list
+from dbs.models import Image, ImageLineage, PackageSet, Rpm
+
+
+class ImageLineageTest(TestCase):
+    def setUp(self):
+        # base <- child <- grandchild, other
+        base = Image.create('base', Image.STATUS_BASE, tags=[])
+        child = Image.create('child', Image.STATUS_BUILD, tags=[], parent=base)
+        Image.create('grandchild', Image.STATUS_BUILD, tags=[], parent=child)
+        Image.create('other', Image.STATUS_BASE, tags=[])
+
+    def lineage(self):
+        return set(ImageLineage.objects.values_list('ancestor', 'descendant', 'depth'))
+
+    def test_attach(self):
+        self.assertEqual(ImageLineage.objects.ancestors_as_list('grandchild'), ['child', 'base'])
+        self.assertEqual(ImageLineage.objects.descendants_as_list('base'), ['child', 'grandchild'])
+        self.assertEqual(ImageLineage.objects.depth_of('grandchild'), 2)
+        self.assertEqual(ImageLineage.objects.depth_of('base'), 0)
+        self.assertEqual(Image.objects.descendants_as_list('child'), ['child', 'grandchild'])
+
+    def test_reparent_moves_subtree(self):
+        Image.objects.filter(hash='child').update(parent='other')
+        ImageLineage.objects.attach('child', 'other')
+        self.assertEqual(ImageLineage.objects.ancestors_as_list('grandchild'), ['child', 'other'])
+        self.assertEqual(ImageLineage.objects.descendants_as_list('other'), ['child', 'grandchild'])
+        # no stale rows of the old parent are left
+        self.assertEqual(ImageLineage.objects.descendants_as_list('base'), [])
+        self.assertEqual(ImageLineage.objects.filter(ancestor='base').count(), 1)
+
+    def test_detach_makes_base_image(self):
+        ImageLineage.objects.attach('child', None)
+        self.assertEqual(ImageLineage.objects.ancestors_as_list('grandchild'), ['child'])
+        self.assertEqual(ImageLineage.objects.depth_of('child'), 0)
+        self.assertEqual(ImageLineage.objects.descendants_as_list('base'), [])
+
+    def test_cycle_is_refused(self):
+        before = self.lineage()
+        ImageLineage.objects.attach('base', 'grandchild')
+        ImageLineage.objects.attach('child', 'child')
+        self.assertEqual(self.lineage(), before)
+
+    def test_rebuild_matches_attach(self):
+        Image.objects.filter(hash='child').update(parent='other')
+        ImageLineage.objects.attach('child', 'other')
+        expected = self.lineage()
+        ImageLineage.objects.all().delete()
+        self.assertEqual(ImageLineage.objects.rebuild(), len(expected))
+        self.assertEqual(self.lineage(), expected)
+
+    def test_rebuild_survives_cycle_in_parents(self):
+        # corrupted data must not make the rebuild loop forever
+        Image.objects.filter(hash='base').update(parent='grandchild')
+        ImageLineage.objects.rebuild()
+        self.assertEqual(ImageLineage.objects.filter(descendant='grandchild', depth=0).count(), 1)
+        self.assertEqual(len(ImageLineage.objects.ancestors_as_list('grandchild')), 2)
+
+
+
+class PackageSetTest(TestCase):
+    base_nvrs = ['bash-4.3.30-2.fc21', 'glibc-2.20-7.fc21', 'coreutils-8.22-21.fc21', 'yum-3.4.3-153.fc21',
+                 'rpm-4.12.0.1-7.fc21', 'python-2.7.8-7.fc21', 'sed-4.2.2-11.fc21', 'tar-1.28-1.fc21']
+
+    def assertSameAsLegacy(self, image, nvrs):
+        """
+        image has the same rpms as an image storing nvrs the old way, through Content
+        """
+        legacy = Image.create('legacy-' + image.hash, Image.STATUS_BUILD, tags=[])
+        legacy_add_rpms_list(legacy, nvrs)
+        expected = list(Rpm.objects.filter(part_of__image=legacy).values_list('nvr', flat=True).order_by('nvr'))
+        for candidate in (image, legacy):
+            candidate = Image.objects.get(hash=candidate.hash)
+            self.assertEqual(candidate.ordered_rpms_list(), expected)
+            self.assertEqual(candidate.rpms_count, len(expected))
+            prefetched = Image.prefetch_related_data([Image.objects.get(hash=candidate.hash)])[0]
+            self.assertEqual(prefetched.ordered_rpms_list(), expected)
+            self.assertEqual(prefetched.rpms_count, len(expected))
+
+    def create_image(self, image_id, nvrs, base=None):
+        image = Image.create(image_id, Image.STATUS_BUILD, tags=[])
+        image.add_rpms_list(nvrs, base=base)
+        return Image.objects.get(hash=image_id)
+
+    def test_complete_set(self):
+        image = self.create_image('base', self.base_nvrs)
+        self.assertIsNone(image.package_set.base_id)
+        self.assertEqual(image.package_set.size, len(self.base_nvrs))
+        self.assertSameAsLegacy(image, self.base_nvrs)
+
+    def test_delta_set(self):
+        base_set = self.create_image('base', self.base_nvrs).package_set
+        # bash updated, yum removed and httpd added
+        nvrs = ['bash-4.3.33-1.fc21'] + [nvr for nvr in self.base_nvrs[1:] if not nvr.startswith('yum')] + \
+            ['httpd-2.4.10-1.fc21']
+        image = self.create_image('child', nvrs, base=base_set)
+        self.assertEqual(image.package_set.base_id, base_set.id)
+        self.assertEqual(image.package_set.members.filter(removed=True).count(), 2)
+        self.assertEqual(image.package_set.members.filter(removed=False).count(), 2)
+        self.assertSameAsLegacy(image, nvrs)
+
+    def test_delta_of_delta_is_rebased(self):
+        base_set = self.create_image('base', self.base_nvrs).package_set
+        child_set = self.create_image('child', self.base_nvrs + ['httpd-2.4.10-1.fc21'], base=base_set).package_set
+        nvrs = self.base_nvrs[1:] + ['httpd-2.4.10-1.fc21', 'mod_ssl-2.4.10-1.fc21']
+        image = self.create_image('grandchild', nvrs, base=child_set)
+        # deltas are stored only against complete sets
+        self.assertEqual(image.package_set.base_id, base_set.id)
+        self.assertSameAsLegacy(image, nvrs)
+
+    def test_big_difference_is_stored_complete(self):
+        base_set = self.create_image('base', self.base_nvrs).package_set
+        nvrs = ['httpd-2.4.10-1.fc21', 'mod_ssl-2.4.10-1.fc21']
+        image = self.create_image('other', nvrs, base=base_set)
+        self.assertIsNone(image.package_set.base_id)
+        self.assertSameAsLegacy(image, nvrs)
+
+    def test_identical_sets_are_shared(self):
+        first = self.create_image('first', self.base_nvrs)
+        second = self.create_image('second', list(reversed(self.base_nvrs)))
+        self.assertEqual(first.package_set_id, second.package_set_id)
+        self.assertEqual(PackageSet.objects.count(), 1)
+
+    def test_added_rpms_are_merged(self):
+        image = self.create_image('image', self.base_nvrs[:2])
+        image.add_rpms_list(self.base_nvrs[2:])
+        self.assertSameAsLegacy(Image.objects.get(hash='image'), self.base_nvrs)
+
+    def test_legacy_image(self):
+        image = Image.create('legacy', Image.STATUS_BUILD, tags=[])
+        legacy_add_rpms_list(image, self.base_nvrs)
+        image = Image.objects.get(hash='legacy')
+        self.assertIsNone(image.package_set_id)
+        self.assertEqual(image.ordered_rpms_list(), sorted(self.base_nvrs))
+        self.assertEqual(image.rpms_count, len(self.base_nvrs))
+        prefetched = Image.prefetch_related_data([image])[0]
+        self.assertEqual(prefetched.ordered_rpms_list(), sorted(self.base_nvrs))
+        # adding rpms converts the image to a package set with the old rpms
+        image.add_rpms_list(['httpd-2.4.10-1.fc21'])
+        self.assertSameAsLegacy(Image.objects.get(hash='legacy'), self.base_nvrs + ['httpd-2.4.10-1.fc21'])
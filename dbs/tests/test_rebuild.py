@@ -0,0 +1,52 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import json
+
+from django.test import TestCase
+
+from dbs import rebuild
+from dbs.models import Image, RebuildRun, RebuildStep, Task, TaskData
+
+
+class RebuildTest(TestCase):
+    def setUp(self):
+        self.sent = []
+        self.build_docker_images = rebuild.builder_api.build_docker_images
+        rebuild.builder_api.build_docker_images = self.sent.extend
+        self.new_build_task = rebuild.new_build_task
+
+    def tearDown(self):
+        rebuild.builder_api.build_docker_images = self.build_docker_images
+        rebuild.new_build_task = self.new_build_task
+
+    def create_image(self, image_id, parent=None):
+        task = Task.objects.create(builddev_id='buildroot-fedora', type=Task.TYPE_BUILD, owner='test',
+                                   status=Task.STATUS_SUCCESS, task_data=TaskData.objects.create(
+                                       json=json.dumps({'git_url': 'https://example.com/%s.git' % image_id,
+                                                        'tag': image_id})))
+        return Image.create(image_id, Image.STATUS_BUILD, tags=[], task=task, parent=parent)
+
+    def test_nothing_to_rebuild(self):
+        Image.create('base', Image.STATUS_BASE, tags=[])
+        run = rebuild.start_rebuild('base', 'test')
+        self.assertEqual(run.status, RebuildRun.STATUS_SUCCESS)
+        self.assertIsNotNone(run.date_finished)
+        self.assertEqual(self.sent, [])
+
+    def test_concurrent_advance_starts_steps_once(self):
+        base = Image.create('base', Image.STATUS_BASE, tags=[])
+        self.create_image('first', base)
+        self.create_image('second', base)
+        run_ids = []
+
+        def new_build_task(*args, **kwargs):
+            # another callback advances the run while this one is starting steps
+            if not run_ids:
+                run_ids.append(RebuildRun.objects.get().id)
+                rebuild.advance_rebuild(run_ids[0])
+            return self.new_build_task(*args, **kwargs)
+
+        rebuild.new_build_task = new_build_task
+        run = rebuild.start_rebuild('base', 'test', concurrency=2)
+        self.assertEqual(sorted(build['tag'] for build in self.sent), ['first', 'second'])
+        self.assertEqual(run.steps.filter(status=RebuildStep.STATUS_RUNNING, task__isnull=False).count(), 2)
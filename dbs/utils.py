@@ -18,3 +18,17 @@ def chain_dict_get(dict_object, keys_list, default=None):
         except (KeyError, TypeError):
             return default
     return d
+
+
+def chunks(items, size):
+    """
+    split sequence into lists of at most size items, e.g. to keep
+    the number of parameters of an SQL IN (...) lookup under control
+
+    :param items: sequence
+    :param size: maximal length of a chunk
+    :return: generator of lists
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
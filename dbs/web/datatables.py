@@ -0,0 +1,113 @@
+from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
+
+import logging
+from functools import reduce
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import JsonResponse
+from django.views.generic import View
+
+__all__ = ('Column', 'DataTablesView', 'choices_search')
+
+
+logger = logging.getLogger(__name__)
+
+
+class Column(object):
+    """
+    column of a table in DataTables server-side mode
+
+    :param order_by: field to order by, None if the column is not orderable
+    :param search: function(value) returning Q matching rows which contain
+                   value in this column, None if the column is not searchable
+    """
+    def __init__(self, order_by=None, search=None):
+        self.order_by = order_by
+        self.search = search
+
+
+def choices_search(field, names):
+    """
+    return search function matching values whose display name contains the searched value
+
+    :param field: name of the field
+    :param names: dict {value: display name}
+    """
+    def search(value):
+        return Q(**{'%s__in' % field: [key for key, name in names.items() if value.lower() in name.lower()]})
+    return search
+
+
+def _int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class DataTablesView(View):
+    """
+    JSON endpoint of a table in DataTables (1.10) server-side mode
+
+    Paging (start, length), ordering (order[i][column], order[i][dir]),
+    global search (search[value]) and column search (columns[i][search][value])
+    are done by the database; only the requested page is loaded and
+    returned as rows of HTML cells:
+
+        {"draw": ..., "recordsTotal": ..., "recordsFiltered": ..., "data": [[cell, ...], ...]}
+    """
+    # Column for every column of the table
+    columns = ()
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def get_rows(self, objects):
+        """
+        return list of rows (lists of HTML cells) of objects on the requested page
+        """
+        raise NotImplementedError
+
+    def filter_queryset(self, queryset, params):
+        value = params.get('search[value]', '').strip()
+        if value:
+            matches = [column.search(value) for column in self.columns if column.search]
+            queryset = queryset.filter(reduce(lambda a, b: a | b, matches)) if matches else queryset.none()
+        for index, column in enumerate(self.columns):
+            value = params.get('columns[%d][search][value]' % index, '').strip()
+            if value and column.search:
+                queryset = queryset.filter(column.search(value))
+        return queryset
+
+    def order_queryset(self, queryset, params):
+        order_by = []
+        index = 0
+        while 'order[%d][column]' % index in params:
+            column = _int(params['order[%d][column]' % index], -1)
+            if 0 <= column < len(self.columns) and self.columns[column].order_by:
+                prefix = '-' if params.get('order[%d][dir]' % index) == 'desc' else ''
+                order_by.append(prefix + self.columns[column].order_by)
+            index += 1
+        # rows with equal values would move between pages
+        order_by.append('-pk' if order_by and order_by[-1].startswith('-') else 'pk')
+        return queryset.order_by(*order_by)
+
+    def get(self, request, *args, **kwargs):
+        params = request.GET
+        start = max(_int(params.get('start'), 0), 0)
+        length = _int(params.get('length'), settings.DBS_API_PAGE_SIZE)
+        if length < 0 or length > settings.DBS_API_MAX_PAGE_SIZE:
+            # -1 means all rows
+            length = settings.DBS_API_MAX_PAGE_SIZE
+        queryset = self.get_queryset()
+        total = queryset.count()
+        filtered = self.filter_queryset(queryset, params)
+        filtered_count = total if filtered is queryset else filtered.count()
+        page = list(self.order_queryset(filtered, params)[start:start + length])
+        return JsonResponse({
+            'draw': _int(params.get('draw'), 0),
+            'recordsTotal': total,
+            'recordsFiltered': filtered_count,
+            'data': self.get_rows(page),
+        })
@@ -6,7 +6,9 @@ from . import views
 
 urlpatterns = patterns('',
     url(r'^tasks/$',    views.task_list),
+    url(r'^tasks/data/$',  views.task_list_data, name="tasks/data"),
     url(r'^images/$',   views.image_list),
+    url(r'^images/data/$', views.image_list_data, name="images/data"),
     url(r'^image/(?P<hash>[a-zA-Z0-9]+)/$', views.image_detail, name="image/detail"),
     url(r'^task/(?P<task_id>[0-9]+)/$', views.task_detail, name="task/detail"),
     url(r'^$',           views.home),
@@ -1,27 +1,117 @@
 from __future__ import absolute_import, division, generators, nested_scopes, print_function, unicode_literals, with_statement
 
+from django.core.urlresolvers import reverse
+from django.db.models import Count, Q
 from django.shortcuts import render, get_object_or_404
-from django.views.generic import ListView, DetailView
+from django.utils import formats, timezone
+from django.utils.html import format_html
+from django.views.generic import DetailView, TemplateView
 
-from ..models import Image, Task
+from ..models import Image, ImageRegistryRelation, Rpm, Tag, Task
+from .datatables import Column, DataTablesView, choices_search
 
 def home(request):
     return render(request, 'home.html')
 
 
-class ImageListView(ListView):
-    model = Image
+def image_link(image_id):
+    return format_html('<a href="{0}">{1}</a>', reverse('image/detail', args=(image_id,)), image_id)
+
+
+def local_datetime(value):
+    """
+    format datetime the same way as templates do
+    """
+    return formats.localize(timezone.template_localtime(value)) if value else ''
+
+
+class ImageListView(TemplateView):
+    """
+    rows of the list are loaded by ImageListDataView
+    """
+    template_name = 'dbs/image_list.html'
 
 image_list = ImageListView.as_view()
 
 
 
-class TaskListView(ListView):
-    model = Task
+class ImageListDataView(DataTablesView):
+    columns = (
+        Column('hash', lambda value: Q(hash__icontains=value)),
+        Column('parent', lambda value: Q(parent__hash__icontains=value)),
+        Column(None, lambda value: Q(hash__in=ImageRegistryRelation.objects.filter(tag__name__icontains=value)
+                                                                            .values('image'))),
+        Column('status', choices_search('status', Image._STATUS_NAMES)),
+        Column('package_set__size'),
+        Column(),
+    )
+
+    def get_queryset(self):
+        return Image.objects.select_related('package_set') \
+            .only('hash', 'parent', 'status', 'package_set__size')
+
+    def get_rows(self, images):
+        tags = Tag.objects.for_images_as_dict([image.hash for image in images])
+        rpms_counts = dict((image.hash, image.package_set.size) for image in images if image.package_set_id)
+        # images stored before package sets were introduced
+        rpms_counts.update(Rpm.objects.filter(part_of__image__in=[
+            image.hash for image in images if not image.package_set_id
+        ]).values_list('part_of__image').annotate(count=Count('id')))
+        return [[
+            image_link(image.hash),
+            image_link(image.parent_id) if image.parent_id else '',
+            format_html('{0}', ' '.join(tags[image.hash])),
+            image.get_status(),
+            'Packages: %d' % rpms_counts.get(image.hash, 0),
+            '<a href="#">show logs</a>',
+        ] for image in images]
+
+image_list_data = ImageListDataView.as_view()
+
+
+
+class TaskListView(TemplateView):
+    """
+    rows of the list are loaded by TaskListDataView
+    """
+    template_name = 'dbs/task_list.html'
 
 task_list = TaskListView.as_view()
 
 
+
+class TaskListDataView(DataTablesView):
+    columns = (
+        Column('status', choices_search('status', Task._STATUS_NAMES)),
+        Column('type', choices_search('type', Task._TYPE_NAMES)),
+        Column('date_started'),
+        Column('date_finished'),
+        Column('image__hash', lambda value: Q(image__hash__icontains=value)),
+    )
+
+    def get_queryset(self):
+        return Task.objects.select_related('image') \
+            .only('id', 'status', 'type', 'date_started', 'date_finished', 'image__hash')
+
+    def get_rows(self, tasks):
+        rows = []
+        for task in tasks:
+            try:
+                image = image_link(task.image.hash)
+            except Image.DoesNotExist:
+                image = 'There is no image'
+            rows.append([
+                format_html('<a href="{0}">{1}</a>', reverse('task/detail', args=(task.id,)), task.get_status()),
+                task.get_type(),
+                local_datetime(task.date_started),
+                local_datetime(task.date_finished),
+                image,
+            ])
+        return rows
+
+task_list_data = TaskListDataView.as_view()
+
+
 class ImageView(DetailView):
     model = Image
 
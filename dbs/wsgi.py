@@ -9,8 +9,16 @@ For more information on this file, see
 https://docs.djangoproject.com/en/1.7/howto/deployment/wsgi/
 """
 
+import logging
 import os
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dbs.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+# callbacks of tasks sent before restart were lost together with the previous process
+from dbs.api.core import watch_unfinished_tasks
+try:
+    watch_unfinished_tasks()
+except Exception:
+    logging.getLogger(__name__).exception('Failed to watch unfinished tasks')